@@ -0,0 +1,157 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class NoAccountsAvailable(Exception):
+    """Все аккаунты выключены (например, не удалось подключиться)"""
+
+
+class AccountScheduler:
+    """
+    Планировщик аккаунтов с учётом FloodWait.
+
+    Свободные аккаунты лежат в min-heap по времени, с которого они доступны
+    (при равенстве — дольше всех не использованный). acquire() выдаёт аккаунт
+    в эксклюзивное пользование, release() возвращает его в кучу,
+    report_flood_wait() замораживает аккаунт по FloodWait, defer() просто
+    откладывает его (например, до повторного подключения).
+    Ожидающие корутины спят на asyncio.Condition до ближайшего освобождения.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.available_at = [0.0] * count  # time.time(), с которого аккаунт доступен
+        self.flood_until = [0.0] * count  # time.time(), до которого аккаунт в FloodWait
+        self.in_use = set()
+        self.versions = [0] * count
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = asyncio.Condition()
+        for idx in range(count):
+            self._push(idx)
+
+    def _push(self, idx):
+        # Старые записи аккаунта в куче становятся недействительными по версии
+        self.versions[idx] += 1
+        heapq.heappush(self.heap, (self.available_at[idx], next(self.sequence), idx, self.versions[idx]))
+
+    def _peek(self):
+        """Ближайшая действительная запись кучи или None"""
+        while self.heap:
+            available_at, _, idx, version = self.heap[0]
+            if idx in self.in_use or version != self.versions[idx]:
+                heapq.heappop(self.heap)
+                continue
+            return available_at, idx
+        return None
+
+    async def acquire(self):
+        """Ждёт и выдаёт индекс ближайшего доступного аккаунта"""
+        idx, _ = await self.acquire_timed()
+        return idx
+
+    async def acquire_timed(self):
+        """
+        То же, что acquire, но возвращает (индекс, секунды ожидания из-за FloodWait):
+        время, когда ближайший аккаунт был свободен, но заморожен report_flood_wait.
+        Остальное ожидание — все аккаунты заняты или на паузе между чатами.
+        """
+        flood_wait = 0.0
+        async with self.condition:
+            while True:
+                top = self._peek()
+                if top is None:
+                    if not self.in_use:
+                        raise NoAccountsAvailable("Нет ни одного аккаунта")
+                    await self.condition.wait()
+                    continue
+                available_at, idx = top
+                delay = available_at - time.time()
+                if delay <= 0:
+                    heapq.heappop(self.heap)
+                    self.in_use.add(idx)
+                    return idx, flood_wait
+                if delay == float('inf'):
+                    if not self.in_use:
+                        raise NoAccountsAvailable("Нет ни одного доступного аккаунта")
+                    await self.condition.wait()
+                    continue
+                logger.warning(f"Все аккаунты заняты или в FloodWait. Жду до {int(delay)} секунд...")
+                flooded = self.flood_until[idx] >= available_at
+                started = time.perf_counter()
+                try:
+                    await asyncio.wait_for(self.condition.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                if flooded:
+                    flood_wait += time.perf_counter() - started
+
+    def try_acquire(self):
+        """Выдаёт аккаунт, только если какой-то свободен прямо сейчас; иначе None"""
+        top = self._peek()
+        if top is None or top[0] > time.time():
+            return None
+        heapq.heappop(self.heap)
+        self.in_use.add(top[1])
+        return top[1]
+
+    async def release(self, idx, cooldown=0):
+        """Возвращает аккаунт; cooldown — пауза перед следующим использованием"""
+        async with self.condition:
+            self.in_use.discard(idx)
+            if cooldown:
+                self.available_at[idx] = max(self.available_at[idx], time.time() + cooldown)
+            self._push(idx)
+            self.condition.notify_all()
+
+    def _postpone(self, idx, until):
+        self.available_at[idx] = max(self.available_at[idx], until)
+        if idx not in self.in_use:
+            self._push(idx)
+        self.condition.notify_all()
+
+    async def defer(self, idx, seconds):
+        """Откладывает аккаунт на seconds секунд; ожидание не считается FloodWait"""
+        async with self.condition:
+            self._postpone(idx, time.time() + seconds)
+
+    async def report_flood_wait(self, idx, seconds):
+        """Помечает конкретный аккаунт замороженным (FloodWait) на seconds секунд"""
+        async with self.condition:
+            until = time.time() + seconds
+            self.flood_until[idx] = max(self.flood_until[idx], until)
+            self._postpone(idx, until)
+
+    async def disable(self, idx):
+        """Выключает аккаунт до конца работы (например, клиент не подключился)"""
+        await self.defer(idx, float('inf'))
+
+    def is_enabled(self, idx):
+        return self.available_at[idx] != float('inf')
+
+    async def wait_available(self, idx):
+        """
+        Ждёт, пока конкретный аккаунт снова станет доступен (без захвата).
+        Возвращает секунды ожидания из-за FloodWait, как acquire_timed.
+        """
+        flood_wait = 0.0
+        while True:
+            delay = self.available_at[idx] - time.time()
+            if delay <= 0:
+                return flood_wait
+            if delay == float('inf'):
+                raise NoAccountsAvailable(f"Аккаунт {idx} выключен")
+            flooded = self.flood_until[idx] >= self.available_at[idx]
+            logger.info(f"Аккаунт {idx} {'в FloodWait' if flooded else 'отложен'}, жду {int(delay)} секунд...")
+            started = time.perf_counter()
+            await asyncio.sleep(delay)
+            if flooded:
+                flood_wait += time.perf_counter() - started
+
+    def is_available(self, idx):
+        return self.available_at[idx] <= time.time()
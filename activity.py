@@ -0,0 +1,307 @@
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+from array import array
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityStats:
+    """
+    Накопитель метрик активности чата за один проход по истории.
+
+    Сообщения подаются от новых к старым (как их отдаёт Telegram), по каждому
+    хранится только дата и id отправителя — объекты Message не сохраняются.
+    """
+
+    def __init__(self, hours=24, days=30, now=None):
+        self.hours = hours
+        self.days = days
+        self.now = now or datetime.now(timezone.utc)
+        self.recent_since = self.now - timedelta(hours=hours)
+        self.window_since = self.now - timedelta(days=days)
+        self.recent_since_ts = self.recent_since.timestamp()
+        self.window_since_ts = self.window_since.timestamp()
+        self.day_by_index = {}
+        self.recent = []  # (timestamp, sender_id) сообщений за последние `hours` часов
+        self.recent_senders = set()
+        self.senders_by_day = defaultdict(set)
+        self.days_with_messages = set()
+        self.scanned = 0
+        self.last_id = 0
+        self.oldest_ts = None
+        self.reached_start = False
+        # Время, до которого окно собрано без пропусков (см. finish)
+        self.covered_since_ts = None
+
+    def add(self, date, sender_id=None, message_id=None):
+        """
+        Учитывает одно сообщение. Возвращает False, если сообщение старше окна
+        в `days` дней — дальше историю читать не нужно.
+        """
+        return self.add_ts(int(date.timestamp()), sender_id, message_id)
+
+    def add_ts(self, ts, sender_id=None, message_id=None):
+        """То же, что add, но дата — unix timestamp (для сырых TL-страниц)"""
+        if ts <= self.window_since_ts:
+            self.reached_start = True
+            return False
+        self.scanned += 1
+        if self.oldest_ts is None or ts < self.oldest_ts:
+            self.oldest_ts = ts
+        if message_id is not None and message_id > self.last_id:
+            self.last_id = message_id
+        day = self._day(ts)
+        self.days_with_messages.add(day)
+        if sender_id is not None:
+            self.senders_by_day[day].add(sender_id)
+        if ts > self.recent_since_ts:
+            self.recent.append((ts, sender_id))
+            if sender_id is not None:
+                self.recent_senders.add(sender_id)
+        return True
+
+    def finish(self, exhausted=False):
+        """
+        Отмечает конец прохода. Окно полное, если проход дошёл до его начала или
+        история кончилась раньше лимита (exhausted); иначе оно покрывает время
+        только до самого старого прочитанного сообщения.
+        """
+        if exhausted or self.reached_start:
+            self.covered_since_ts = self.window_since_ts
+        else:
+            self.covered_since_ts = self.oldest_ts if self.oldest_ts is not None else self.now.timestamp()
+
+    @property
+    def complete(self):
+        return self.covered_since_ts is not None and self.covered_since_ts <= self.window_since_ts
+
+    def covers(self, state):
+        """Покрывает ли сохранённое окно state всё текущее окно (иначе его нельзя склеивать)"""
+        covered_since = state.get('covered_since')
+        return covered_since is not None and covered_since <= self.window_since_ts
+
+    def _day(self, ts):
+        """Дата (UTC) по timestamp с кэшем по номеру дня"""
+        index = ts // 86400
+        day = self.day_by_index.get(index)
+        if day is None:
+            day = datetime.fromtimestamp(index * 86400, timezone.utc).date()
+            self.day_by_index[index] = day
+        return day
+
+    def result(self):
+        """Итоговые метрики в формате analyze_dau / analyze_dau_monthly"""
+        daily_counts = [len(users) for users in self.senders_by_day.values()]
+        avg_dau = round(sum(daily_counts) / len(daily_counts), 2) if daily_counts else None
+        return {
+            'total_messages': len(self.recent),
+            'unique_senders': len(self.recent_senders),
+            'time_period': f'Последние {self.hours} часов',
+            'avg_dau': avg_dau,
+            'days_counted': len(daily_counts),
+            'days_with_messages': len(self.days_with_messages),
+        }
+
+    def to_state(self):
+        """Компактное состояние окна для WatermarkStore"""
+        return {
+            'last_id': self.last_id,
+            'updated_at': self.now.isoformat(),
+            'covered_since': self.covered_since_ts,
+            'recent': [list(item) for item in self.recent],
+            'days': {day.isoformat(): sorted(users) for day, users in self.senders_by_day.items()},
+            'message_days': sorted(day.isoformat() for day in self.days_with_messages),
+        }
+
+    def merge_state(self, state):
+        """
+        Добавляет сохранённое окно предыдущего анализа. Всё, что вышло за границы
+        текущего окна, отбрасывается; пограничный день учитывается целиком.
+        Склеивать можно только окно, для которого covers(state) истинно.
+        """
+        self.last_id = max(self.last_id, state.get('last_id', 0))
+        for ts, sender_id in state.get('recent', []):
+            if ts > self.recent_since_ts:
+                self.recent.append((ts, sender_id))
+                if sender_id is not None:
+                    self.recent_senders.add(sender_id)
+        first_day = self.window_since.date()
+        for day_str, users in state.get('days', {}).items():
+            day = datetime.fromisoformat(day_str).date()
+            if day >= first_day:
+                self.senders_by_day[day].update(users)
+        for day_str in state.get('message_days', []):
+            day = datetime.fromisoformat(day_str).date()
+            if day >= first_day:
+                self.days_with_messages.add(day)
+
+
+class WatermarkStore:
+    """
+    Водяные знаки по чатам: id последнего увиденного сообщения и скользящее окно
+    отправителей по дням. Позволяет при повторном анализе догружать только новые
+    сообщения (min_id) вместо всей истории за 30 дней.
+
+    Хранятся в SQLite (WAL), одна строка на чат: запись окна одного чата не
+    переписывает остальные, и в памяти держится только то, что сейчас нужно.
+    """
+
+    def __init__(self, db_path='watermarks.db', legacy_json='watermarks.json'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks ("
+            "chat_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at TEXT NOT NULL)"
+        )
+        self.conn.commit()
+        if legacy_json:
+            self._migrate_json(legacy_json)
+
+    def _migrate_json(self, json_path):
+        """Однократный перенос старого watermarks.json; файл переименовывается в *.migrated"""
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            now = datetime.now(timezone.utc).isoformat()
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO watermarks (chat_id, state, updated_at) VALUES (?, ?, ?)",
+                    ((chat_id, json.dumps(state, ensure_ascii=False), now) for chat_id, state in legacy.items())
+                )
+            os.replace(json_path, f"{json_path}.migrated")
+            logger.info(f"Водяные знаки из {json_path} перенесены в {self.db_path}: {len(legacy)} записей")
+        except Exception as e:
+            logger.error(f"Ошибка при переносе водяных знаков из {json_path}: {e}")
+
+    def get(self, chat_id):
+        try:
+            with self.lock:
+                row = self.conn.execute("SELECT state FROM watermarks WHERE chat_id = ?", (chat_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке водяного знака {chat_id}: {e}")
+            return None
+
+    def set(self, chat_id, state):
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "INSERT INTO watermarks (chat_id, state, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                    (chat_id, json.dumps(state, ensure_ascii=False), datetime.now(timezone.utc).isoformat())
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении водяного знака {chat_id}: {e}")
+
+    def drop(self, chat_id):
+        try:
+            with self.lock, self.conn:
+                self.conn.execute("DELETE FROM watermarks WHERE chat_id = ?", (chat_id,))
+        except Exception as e:
+            logger.error(f"Ошибка при удалении водяного знака {chat_id}: {e}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Квантили t-распределения Стьюдента (0.975) для 95% доверительного интервала
+T_975 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306,
+         9: 2.262, 10: 2.228, 12: 2.179, 15: 2.131, 20: 2.086, 25: 2.060, 30: 2.042}
+
+
+def estimate_sample_dau(dates, senders, until_ts, complete=False):
+    """
+    Оценка уникальных отправителей за сутки до until_ts по сообщениям, прочитанным
+    от until_ts назад (от новых к старым). Возвращает (оценка, были ли сообщения в эти сутки).
+
+    Если прочитанное покрывает сутки целиком (или история до них кончилась,
+    complete=True), считаем точно. Иначе объём сообщений за сутки берём из темпа
+    прочитанного, а число уникальных экстраполируем оценкой Chao1 (см. extrapolate_richness):
+    она опирается на отправителей, встреченных один и два раза, и не насыщается
+    раньше времени, когда небольшое ядро пишет большую часть сообщений.
+    """
+    since = until_ts - 86400
+    within = [sender for ts, sender in zip(dates, senders) if ts > since]
+    if not within:
+        return 0.0, False
+    users = [sender for sender in within if sender]
+    unique = len(set(users))
+    if complete or dates[-1] <= since or not users:
+        return float(unique), True
+    span = max(until_ts - dates[-1], 60)
+    daily_messages = len(users) * 86400 / span
+    return extrapolate_richness(users, daily_messages), True
+
+
+def extrapolate_richness(senders, target):
+    """
+    Ожидаемое число уникальных отправителей среди target сообщений по выборке senders
+    (экстраполяция Chao et al., 2014): S + f0 * (1 - (1 - f1 / (n * f0 + f1)) ** m),
+    где f1 и f2 — число отправителей с одним и двумя сообщениями, f0 — оценка Chao1
+    числа ещё не встреченных, m = target - n.
+    """
+    n = len(senders)
+    counts = defaultdict(int)
+    for sender in senders:
+        counts[sender] += 1
+    unique = len(counts)
+    f1 = sum(1 for c in counts.values() if c == 1)
+    f2 = sum(1 for c in counts.values() if c == 2)
+    m = target - n
+    if m <= 0 or not f1 or n < 2:
+        return float(unique)
+    if f2:
+        f0 = (n - 1) / n * f1 * f1 / (2 * f2)
+    else:
+        f0 = (n - 1) / n * f1 * (f1 - 1) / 2
+    if f0 <= 0:
+        return float(unique)
+    return unique + f0 * (1 - (1 - f1 / (n * f0 + f1)) ** m)
+
+
+def summarize_samples(values):
+    """Среднее и 95% доверительный интервал по выборочным оценкам"""
+    k = len(values)
+    if not k:
+        return None, (None, None)
+    mean = sum(values) / k
+    if k == 1:
+        return mean, (None, None)
+    sd = math.sqrt(sum((v - mean) ** 2 for v in values) / (k - 1))
+    df = k - 1
+    t = next((T_975[key] for key in sorted(T_975, reverse=True) if key <= df), 1.96) if df <= 30 else 1.96
+    margin = t * sd / math.sqrt(k)
+    return mean, (max(mean - margin, 0.0), mean + margin)
+
+
+def compact_history(messages):
+    """
+    Из сырой страницы messages.GetHistory достаёт только (id, date, sender id)
+    в компактные массивы; 0 в senders — отправитель не пользователь
+    """
+    ids, dates, senders = array('q'), array('q'), array('q')
+    for message in messages:
+        date = getattr(message, 'date', None)
+        if date is None:  # MessageEmpty
+            continue
+        ids.append(message.id)
+        dates.append(int(date.timestamp()))
+        senders.append(getattr(message.from_id, 'user_id', 0) or 0)
+    return ids, dates, senders
+
+
+def get_sender_id(message):
+    """id пользователя-отправителя или None (каналы, анонимные админы)"""
+    return getattr(message.from_id, 'user_id', None)
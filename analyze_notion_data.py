@@ -13,9 +13,9 @@ def analyze_notion_data():
     # Инициализируем интеграцию с Notion
     notion = NotionIntegration()
     
-    # Экспортируем данные в Excel
+    # Экспортируем данные в Excel из локальной копии базы (синхронизация инкрементальная)
     filename = f"notion_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    notion.export_to_excel(filename)
+    notion.export_to_excel(filename, pages=notion.snapshot_pages())
     
     # Читаем данные из Excel
     df = pd.read_excel(filename)
@@ -85,9 +85,7 @@ def analyze_notion_data():
 
     # ML-оценка для каждого чата напрямую из Notion
     print("\n=== ML-оценка качества чатов (Notion API) ===")
-    notion = NotionIntegration()
-    response = notion.notion.databases.query(database_id=notion.database_id)
-    for page in response.get("results", []):
+    for page in notion.mirror.pages():
         properties = page.get("properties", {})
         chat_id_prop = properties.get("Канал/чат", {}).get("rich_text", [])
         chat_id = chat_id_prop[0].get("text", {}).get("content", "") if chat_id_prop else ""
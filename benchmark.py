@@ -0,0 +1,170 @@
+"""
+Офлайн-бенчмарк пропускной способности TelegramAnalyzer на fake_telegram.
+
+    python benchmark.py --chats 50 --accounts 3 --speedup 200 --flood-probability 0.01
+
+Для каждого режима (MODES) прогоняет одни и те же синтетические чаты через
+process_chat с чистыми кэшами и печатает: чатов/час, запросов на чат,
+p50/p95 времени обработки чата и число FloodWait. Все времена — в
+симулированных секундах (реальное время × speedup). Запись в Notion и ML-оценка
+заменяются заглушками.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import tempfile
+import time
+from collections import Counter
+
+import bot
+from fake_telegram import FakeTelegram, FloodPolicy
+from rate_limiter import DEFAULT_LIMIT, DEFAULT_LIMITS, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Режимы обработки очереди: имя -> coroutine function(analyzer, chat_pages, args)
+MODES = {
+    'sequential': lambda analyzer, pages, args: bot.run_sequential(analyzer, pages),
+    'pool': lambda analyzer, pages, args: bot.run_worker_pool(analyzer, pages, workers=args.workers),
+}
+
+
+class OfflineNotion:
+    """Заглушка NotionIntegration: только запоминает, что было бы записано"""
+
+    def __init__(self):
+        self.updates = []
+
+    analysis_properties = staticmethod(bot.NotionIntegration.analysis_properties)
+
+    def update_page(self, page_id, properties):
+        self.updates.append((page_id, properties["Status"]["select"]["name"]))
+
+
+def chat_page(chat):
+    return {
+        'id': f'page-{chat.id}',
+        'properties': {'Канал/чат': {'rich_text': [{'text': {'content': f'@{chat.username}'}}]}},
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def scaled_rate_limiter(speedup):
+    """Лимиты запросов в симулированном времени"""
+    limits = {method: (rate * speedup, capacity) for method, (rate, capacity) in DEFAULT_LIMITS.items()}
+    return RateLimiter(limits, default=(DEFAULT_LIMIT[0] * speedup, DEFAULT_LIMIT[1]))
+
+
+async def run_mode(mode, args):
+    backend = FakeTelegram(
+        chats=args.chats, seed=args.seed, speedup=args.speedup,
+        flood_policy=FloodPolicy(args.flood_probability, (args.flood_min, args.flood_max), seed=args.seed),
+    )
+    accounts = [{'api_id': str(i), 'api_hash': '', 'session': f'bench_{i}'} for i in range(args.accounts)]
+    latencies = []
+    statuses = Counter()
+    process_chat = bot.process_chat
+
+    async def timed_process_chat(analyzer, page, account_idx=None):
+        started = time.perf_counter()
+        try:
+            status = await process_chat(analyzer, page, account_idx=account_idx)
+        except bot.AccountUnavailable:
+            raise
+        latencies.append((time.perf_counter() - started) * args.speedup)
+        statuses[status] += 1
+        return status
+
+    saved = bot.process_chat, bot.quality_properties, bot.CHAT_COOLDOWN
+    bot.process_chat = timed_process_chat
+    bot.quality_properties = lambda analysis_results: {}
+    bot.CHAT_COOLDOWN = tuple(seconds / args.speedup for seconds in saved[2])
+    cwd = os.getcwd()
+    # process_chat печатает ход анализа в stdout — в отчёт бенчмарка это не попадает
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with tempfile.TemporaryDirectory() as workdir, quiet:
+        # Кэши, журнал и водяные знаки — свои для каждого режима
+        os.chdir(workdir)
+        analyzer = None
+        try:
+            analyzer = bot.TelegramAnalyzer(accounts=accounts, client_factory=backend.client_factory, notion=OfflineNotion())
+            analyzer.rate_limiter = scaled_rate_limiter(args.speedup)
+            await analyzer.start()
+            started = time.perf_counter()
+            await MODES[mode](analyzer, [chat_page(chat) for chat in backend.chats], args)
+            elapsed = (time.perf_counter() - started) * args.speedup
+        finally:
+            bot.process_chat, bot.quality_properties, bot.CHAT_COOLDOWN = saved
+            if analyzer:
+                if analyzer.refresh_task:
+                    analyzer.refresh_task.cancel()
+                await asyncio.to_thread(analyzer.writer.close)
+                analyzer.journal.close()
+                analyzer.tracer.close()
+                analyzer.cache.close()
+                analyzer.watermarks.close()
+                analyzer.entity_cache.close()
+            os.chdir(cwd)
+
+    processed = statuses['analyzed'] + statuses['error']
+    by_method = Counter()
+    for (_, method), count in backend.requests.items():
+        by_method[method] += count
+    return {
+        'mode': mode,
+        'chats': processed,
+        'errors': statuses['error'],
+        'elapsed': elapsed,
+        'chats_per_hour': processed / max(elapsed, 1e-9) * 3600,
+        'requests_per_chat': sum(by_method.values()) / max(processed, 1),
+        'requests_by_method': by_method,
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'flood_waits': sum(backend.flood_waits.values()),
+    }
+
+
+def print_report(results):
+    print(f"{'режим':<12}{'чатов':>7}{'ошибок':>8}{'чатов/час':>11}{'запр./чат':>11}{'p50, с':>9}{'p95, с':>9}{'FloodWait':>11}")
+    for r in results:
+        print(
+            f"{r['mode']:<12}{r['chats']:>7}{r['errors']:>8}{r['chats_per_hour']:>11.1f}"
+            f"{r['requests_per_chat']:>11.1f}{r['p50'] or 0:>9.1f}{r['p95'] or 0:>9.1f}{r['flood_waits']:>11}"
+        )
+    for r in results:
+        methods = ', '.join(f'{method}={count}' for method, count in r['requests_by_method'].most_common())
+        print(f"{r['mode']}: {methods}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк TelegramAnalyzer')
+    parser.add_argument('--chats', type=int, default=50)
+    parser.add_argument('--accounts', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None, help='воркеров в режиме pool (по умолчанию по числу аккаунтов)')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES))
+    parser.add_argument('--scanner', choices=('iter', 'raw'), default=bot.HISTORY_SCANNER, help='способ чтения истории (HISTORY_SCANNER)')
+    parser.add_argument('--speedup', type=float, default=100.0, help='во сколько раз ускорить время')
+    parser.add_argument('--flood-probability', type=float, default=0.0, help='вероятность FloodWait на запрос')
+    parser.add_argument('--flood-min', type=float, default=5.0)
+    parser.add_argument('--flood-max', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+    bot.HISTORY_SCANNER = args.scanner
+    results = [asyncio.run(run_mode(mode, args)) for mode in args.modes]
+    print_report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,44 @@
 import os
 import asyncio
+import functools
 import random
-import json
+import time
 import logging
+from array import array
 from datetime import datetime, timedelta, timezone
 from telethon import TelegramClient
-from telethon.tl.functions.channels import GetFullChannelRequest
-from telethon.tl.types import Channel
-from telethon.errors import FloodWaitError, ChatAdminRequiredError, ChannelPrivateError
+from telethon.tl.functions.channels import GetChannelsRequest, GetFullChannelRequest
+from telethon.tl.functions.messages import GetHistoryRequest
+from telethon.tl.types import Channel, InputChannel, InputPeerChannel
+from telethon.utils import get_input_peer
+from telethon.errors import (
+    FloodWaitError, ChatAdminRequiredError, ChannelPrivateError, ChannelInvalidError, PeerIdInvalidError
+)
 import pandas as pd
 from dotenv import load_dotenv
 import re
 import sys
 from proxy_pool import ProxyPool
+from cache import Cache
+from run_journal import RunJournal
+from tracing import Tracer
+from report_sink import ReportSink
+from rate_limiter import RateLimiter
+from account_scheduler import AccountScheduler, NoAccountsAvailable
+from entity_cache import EntityCache
+from chat_ids import normalize_chat_id
 from proxies import PROXIES
+from metrics import (
+    CACHE_LOOKUPS, FLOOD_WAIT_SECONDS, FLOOD_WAITS, TELEGRAM_REQUEST_SECONDS, TELEGRAM_REQUESTS, start_http_server
+)
 import glob
 import subprocess
 from notion_integration import NotionIntegration
-from evaluate_chat import evaluate_chat
+from notion_writer import NotionWriter
+from evaluate_chat import analysis_metrics, evaluate_chat, predict_quality, prediction_properties
+from activity import (
+    ActivityStats, WatermarkStore, compact_history, estimate_sample_dau, get_sender_id, summarize_samples
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -39,42 +60,99 @@ results = []
 analyzed_chats_total = 0
 MAX_CHATS_BEFORE_PAUSE = 250
 PAUSE_SECONDS = 600  # 10 минут
+# Число параллельных воркеров (по одному на аккаунт); 1 — последовательный режим
+ANALYSIS_WORKERS = int(os.getenv('ANALYSIS_WORKERS', '1'))
+# Способ чтения истории: 'iter' — iter_messages, 'raw' — сырые страницы messages.GetHistory
+HISTORY_SCANNER = os.getenv('HISTORY_SCANNER', 'iter')
+# Подсчёт сообщений: 'scan' — по прочитанной истории, 'estimate' — по разнице id сообщений
+MESSAGE_COUNT_MODE = os.getenv('MESSAGE_COUNT_MODE', 'scan')
+# Выборочная оценка DAU для чатов, чья история за 30 дней не влезает в лимит:
+# число точек выборки (0 — выключено), размер страницы и сколько страниц не больше читать в каждой точке
+DAU_SAMPLES = int(os.getenv('DAU_SAMPLES', '10'))
+DAU_SAMPLE_PAGE = int(os.getenv('DAU_SAMPLE_PAGE', '100'))
+DAU_SAMPLE_MAX_PAGES = int(os.getenv('DAU_SAMPLE_MAX_PAGES', '5'))
+# Таймаут подключения одного клиента (секунды) и ленивое подключение при первом использовании
+CLIENT_CONNECT_TIMEOUT = float(os.getenv('CLIENT_CONNECT_TIMEOUT', '30'))
+LAZY_CLIENTS = os.getenv('LAZY_CLIENTS', '0') == '1'
+# Период фоновой проверки прокси в секундах (0 — не проверять)
+PROXY_HEALTH_INTERVAL = float(os.getenv('PROXY_HEALTH_INTERVAL', '0'))
+# Порт HTTP-эндпоинта метрик Prometheus (0 — не запускать)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+# Файл трассировки этапов обработки чатов (пусто — не трассировать); сводка: python tracing.py
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+# Отчёт текущего запуска: формат (xlsx, csv, parquet) и как часто обновлять его снимок (в чатах)
+REPORT_FORMAT = os.getenv('REPORT_FORMAT', 'xlsx')
+REPORT_SNAPSHOT_EVERY = int(os.getenv('REPORT_SNAPSHOT_EVERY', '25'))
+REPORT_COLUMNS = [
+    'chat_id', 'status', 'name', 'members_count', 'dau', 'dau_percent', 'monthly_avg_dau',
+    'monthly_avg_dau_percent', 'days_with_messages', 'total_messages', 'messages_30d', 'resume', 'account',
+    'cache_date',
+]
+# Пауза между чатами на одном аккаунте (секунды, случайно в диапазоне)
+CHAT_COOLDOWN = (5, 10)
+# Сколько страниц может ждать отложенной записи в Notion
+NOTION_WRITE_QUEUE = int(os.getenv('NOTION_WRITE_QUEUE', '50'))
+# Как часто фоновое обновление кэша проверяет, не освободился ли аккаунт (секунды)
+REFRESH_IDLE_POLL = 5
+# Сколько каналов запрашивать одним GetChannelsRequest при пакетном обновлении кэша (0 — не пакетировать)
+CHANNEL_BATCH_SIZE = int(os.getenv('CHANNEL_BATCH_SIZE', '100'))
+# Поля, которые есть только в GetFullChannelRequest; остальное отдаёт GetChannelsRequest
+FULL_ONLY_FIELDS = ('description',)
+# Число участников GetChannelsRequest тоже обычно отдаёт (participants_count), но не всегда,
+# поэтому при запросе одного чата за ним надёжнее идти в GetFullChannelRequest
+FULL_INFO_FIELDS = FULL_ONLY_FIELDS + ('members_count',)
 
-class Cache:
-    def __init__(self, cache_file='chat_cache.json'):
-        self.cache_file = cache_file
-        self.cache = self._load_cache()
+class AccountUnavailable(Exception):
+    """Закреплённый за воркером аккаунт ушёл в FloodWait или не подключается"""
 
-    def _load_cache(self):
-        try:
-            if os.path.exists(self.cache_file):
-                with open(self.cache_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            return {}
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке кэша: {e}")
-            return {}
+    def __init__(self, idx, seconds=None):
+        if seconds is None:
+            super().__init__(f"аккаунт {idx} недоступен")
+        else:
+            super().__init__(f"аккаунт {idx} в FloodWait на {seconds} секунд")
+        self.idx = idx
+        self.seconds = seconds
 
-    def _save_cache(self):
-        try:
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
-                json.dump(self.cache, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении кэша: {e}")
+# Обрыв соединения с Telegram (обычно из-за прокси)
+CONNECTION_ERRORS = (ConnectionError, asyncio.TimeoutError)
+# Пауза аккаунта после неудачного подключения: 30 с, 60 с, 120 с... но не больше 10 минут
+RECONNECT_BACKOFF_BASE = 30
+RECONNECT_BACKOFF_MAX = 600
+# Сколько раз подряд запрос чата переживает обрыв соединения, прежде чем чат пропускается
+CONNECTION_RETRIES = 3
 
-    def get(self, chat_id):
-        return self.cache.get(chat_id)
+# Ошибки, после которых сохранённый input peer считается недействительным
+PEER_INVALID_ERRORS = (ChannelInvalidError, ChannelPrivateError, PeerIdInvalidError)
 
-    def set(self, chat_id, data):
-        self.cache[chat_id] = data
-        self._save_cache()
+def username_matches(chat, chat_id):
+    """Принадлежит ли username из chat_id каналу chat (с учётом коллекционных username)"""
+    username = normalize_chat_id(chat_id)
+    usernames = {(chat.username or '').lower()}
+    usernames.update(u.username.lower() for u in (getattr(chat, 'usernames', None) or []))
+    return username in usernames
+
+def channel_fields(chat):
+    """Базовые поля чата, которые есть в самом объекте Channel"""
+    fields = {
+        'title': chat.title,
+        'is_public': not chat.megagroup,
+        'date_created': chat.date.isoformat(),
+    }
+    if getattr(chat, 'participants_count', None) is not None:
+        fields['members_count'] = chat.participants_count
+    return fields
 
 class TelegramAnalyzer:
-    def __init__(self):
+    def __init__(self, accounts=None, client_factory=None, notion=None):
+        """
+        accounts — список аккаунтов (по умолчанию из API_ID_N/API_HASH_N в .env);
+        client_factory(idx, account, proxy) — замена TelegramClient (например,
+        fake_telegram для офлайн-бенчмарков); notion — замена NotionIntegration.
+        """
         self.proxy_pool = ProxyPool(PROXIES)
-        self.accounts = []
+        self.accounts = accounts if accounts is not None else []
         i = 1
-        while True:
+        while accounts is None:
             api_id = os.getenv(f'API_ID_{i}')
             api_hash = os.getenv(f'API_HASH_{i}')
             if api_id and api_hash:
@@ -86,172 +164,657 @@ class TelegramAnalyzer:
                 i += 1
             else:
                 break
+        self.client_factory = client_factory
         self.clients = []
-        self.current_client_index = 0
         self.cache = Cache()
-        self.rate_limit = 30  # запросов в секунду
-        self.last_request_time = {}
-        self.floodwait_until = [0] * len(self.accounts)  # timestamp до которого аккаунт "заморожен"
-        self.notion = NotionIntegration()
+        self.journal = RunJournal()
+        self.tracer = Tracer(TRACE_FILE)
+        self.report = None  # ReportSink текущего запуска (создаётся в main)
+        self.refresh_queue = asyncio.Queue()
+        self.refresh_pending = set()
+        self.refresh_task = None
+        self.rate_limiter = RateLimiter()
+        self.watermarks = WatermarkStore()
+        self.entity_cache = EntityCache()
+        self.scheduler = AccountScheduler(len(self.accounts))
+        self.connected = [False] * len(self.accounts)
+        self.connect_failures = [0] * len(self.accounts)
+        self.connect_locks = [asyncio.Lock() for _ in self.accounts]
+        self.login_lock = asyncio.Lock()
+        self.notion = notion or NotionIntegration()
+        self.writer = NotionWriter(self.notion, NOTION_WRITE_QUEUE)
 
     async def start(self):
+        if PROXY_HEALTH_INTERVAL > 0:
+            self.proxy_pool.start_health_checks(PROXY_HEALTH_INTERVAL)
         await self._init_clients()
-        logger.info(f"Бот запущен и готов к работе! Всего аккаунтов: {len(self.accounts)}")
+        available = sum(self.scheduler.is_enabled(idx) for idx in range(len(self.accounts)))
+        logger.info(f"Бот запущен и готов к работе! Всего аккаунтов: {len(self.accounts)}, доступно: {available}")
         print("Бот слушает команды...")
 
+    def _create_client(self, idx, proxy):
+        if self.client_factory:
+            return self.client_factory(idx, self.accounts[idx], proxy)
+        session_path = os.path.abspath(f'telegram_analyzer_{idx+1}.session')
+        return TelegramClient(
+            session_path,
+            self.accounts[idx]["api_id"],
+            self.accounts[idx]["api_hash"],
+            proxy=proxy
+        )
+
     async def _init_clients(self):
-        for idx, account in enumerate(self.accounts):
-            proxy = self.proxy_pool.get_proxy()
-            session_path = os.path.abspath(f'telegram_analyzer_{idx+1}.session')
-            client = TelegramClient(
-                session_path,
-                account["api_id"],
-                account["api_hash"],
-                proxy=proxy
-            )
+        """
+        Создаёт клиентов всех аккаунтов и подключает их параллельно, каждый со своим
+        таймаутом: время старта определяется самым медленным подключением, а не суммой.
+        Аккаунты, которые не смогли подключиться, помечаются недоступными.
+        В ленивом режиме (LAZY_CLIENTS) клиент подключается при первом использовании.
+        """
+        self.client_proxies = [self.proxy_pool.get_proxy() for _ in self.accounts]
+        self.clients = [self._create_client(idx, proxy) for idx, proxy in enumerate(self.client_proxies)]
+        if LAZY_CLIENTS:
+            logger.info("Ленивый режим: клиенты будут подключены при первом использовании")
+            return
+        await asyncio.gather(*(self.ensure_connected(idx) for idx in range(len(self.accounts))))
+
+    async def _connect_client(self, idx):
+        """Подключение с таймаутом; возвращает True, если сессия авторизована"""
+        client = self.clients[idx]
+        await asyncio.wait_for(client.connect(), CLIENT_CONNECT_TIMEOUT)
+        return await asyncio.wait_for(client.is_user_authorized(), CLIENT_CONNECT_TIMEOUT)
+
+    async def ensure_connected(self, idx):
+        """
+        Подключает клиента аккаунта idx, если он ещё не подключён.
+        Возвращает False, если подключиться не удалось. При сетевой ошибке аккаунт
+        откладывается в планировщике с растущей паузой и потом пробует снова;
+        выключается до конца работы он только при ошибках, которые повтор не исправит
+        (например, заблокированный session-файл).
+        """
+        if self.connected[idx]:
+            return True
+        if not self.scheduler.is_enabled(idx):
+            return False
+        account = self.accounts[idx]
+        async with self.connect_locks[idx]:
+            if self.connected[idx]:
+                return True
+            proxy = self.client_proxies[idx]
             try:
-                await client.start()
+                started = time.perf_counter()
+                authorized = await self._connect_client(idx)
+                if proxy:
+                    self.proxy_pool.report_success(proxy, time.perf_counter() - started)
+                if not authorized:
+                    # Сессия не авторизована — нужен интерактивный вход (код из Telegram)
+                    async with self.login_lock:
+                        await self.clients[idx].start()
             except Exception as e:
-                logger.error(f"Ошибка при инициализации клиента {account['session']}: {e}")
+                if proxy and isinstance(e, (asyncio.TimeoutError, ConnectionError, OSError)):
+                    self.proxy_pool.report_failure(proxy)
+                reason = 'таймаут подключения' if isinstance(e, asyncio.TimeoutError) else e
+                logger.error(f"Ошибка при инициализации клиента {account['session']}: {reason}")
                 if 'database is locked' in str(e):
-                    logger.error(f"Session-файл {session_path} заблокирован! Попробуйте перезапустить компьютер и убедитесь, что нет других процессов Python.")
-                raise
-            self.clients.append(client)
+                    logger.error(f"Session-файл {self.clients[idx].session.filename} заблокирован! Попробуйте перезапустить компьютер и убедитесь, что нет других процессов Python.")
+                if isinstance(e, (asyncio.TimeoutError, ConnectionError, OSError)):
+                    self.connect_failures[idx] += 1
+                    backoff = min(RECONNECT_BACKOFF_BASE * 2 ** (self.connect_failures[idx] - 1), RECONNECT_BACKOFF_MAX)
+                    logger.warning(f"Аккаунт {account['session']}: повторное подключение через {backoff} секунд")
+                    await self.scheduler.defer(idx, backoff)
+                else:
+                    await self.scheduler.disable(idx)
+                return False
+            self.connected[idx] = True
+            self.connect_failures[idx] = 0
             logger.info(f"Клиент {account['session']} (api_id={account['api_id']}) успешно инициализирован")
+            return True
 
     async def get_next_client(self):
-        import time
-        now = time.time()
-        for _ in range(len(self.clients)):
-            idx = self.current_client_index
-            if self.floodwait_until[idx] <= now:
-                client = self.clients[idx]
-                account = self.accounts[idx]
-                logger.info(f"Следующий аккаунт для анализа: {account['session']} (api_id={account['api_id']})")
-                self.current_client_index = (self.current_client_index + 1) % len(self.clients)
-                return client, idx
-            self.current_client_index = (self.current_client_index + 1) % len(self.clients)
-        # Если все аккаунты в FloodWait — ждём минимальное время
-        min_wait = min(self.floodwait_until) - now
-        logger.warning(f"Все аккаунты в FloodWait. Жду {int(min_wait)} секунд...")
-        if min_wait > 0:
-            await asyncio.sleep(min_wait)
-        # После ожидания пробуем снова
-        return await self.get_next_client()
+        """Следующий доступный аккаунт по очереди (без эксклюзивного захвата)"""
+        while True:
+            started = time.perf_counter()
+            idx, flood_wait = await self.scheduler.acquire_timed()
+            self.tracer.record('flood_wait', flood_wait)
+            self.tracer.record('wait_account', time.perf_counter() - started - flood_wait)
+            await self.scheduler.release(idx)
+            if await self.ensure_connected(idx):
+                break
+        account = self.accounts[idx]
+        logger.info(f"Следующий аккаунт для анализа: {account['session']} (api_id={account['api_id']})")
+        return self.clients[idx], idx
 
-    async def restart_with_new_ip(self):
-        """Переподключение всех клиентов с новыми IP"""
-        for i, client in enumerate(self.clients):
-            await client.disconnect()
-            await asyncio.sleep(5)  # небольшая пауза для смены IP
+    async def get_client(self, account_idx=None):
+        """
+        Клиент для запроса: следующий свободный аккаунт или, если задан account_idx,
+        конкретный аккаунт (после окончания его FloodWait). Если этот аккаунт
+        выключен или не подключается, бросается AccountUnavailable.
+        """
+        if account_idx is None:
+            return await self.get_next_client()
+        started = time.perf_counter()
+        try:
+            flood_wait = await self.scheduler.wait_available(account_idx)
+        except NoAccountsAvailable:
+            # Закреплённый аккаунт выключен: чат должен вернуться в очередь, а не потеряться
+            raise AccountUnavailable(account_idx)
+        self.tracer.record('flood_wait', flood_wait)
+        self.tracer.record('wait_account', time.perf_counter() - started - flood_wait)
+        if not await self.ensure_connected(account_idx):
+            raise AccountUnavailable(account_idx)
+        return self.clients[account_idx], account_idx
+
+    async def handle_flood_wait(self, idx, error, account_idx=None, chat_id=None):
+        """
+        Регистрирует FloodWait для аккаунта, на котором он случился.
+        Если вызывающий закрепил за собой аккаунт, сообщаем ему об этом исключением,
+        чтобы он вернул аккаунт планировщику вместо ожидания.
+        """
+        wait_time = error.seconds
+        suffix = f" (чат {chat_id})" if chat_id else ""
+        logger.warning(f"⚠️ FloodWait: аккаунт {self.accounts[idx]['session']} заморожен на {wait_time} секунд{suffix}")
+        account = self.accounts[idx]['session']
+        FLOOD_WAITS.inc(account=account)
+        FLOOD_WAIT_SECONDS.inc(wait_time, account=account)
+        await self.scheduler.report_flood_wait(idx, wait_time)
+        if account_idx is not None:
+            raise AccountUnavailable(idx, wait_time)
+
+    async def _call(self, idx, request):
+        """Выполняет TL-запрос от имени аккаунта idx с учётом его лимита на этот метод"""
+        method = type(request).__name__
+        self.tracer.record('rate_limit', await self.rate_limiter.acquire(idx, method))
+        TELEGRAM_REQUESTS.inc(method=method, account=self.accounts[idx]["session"])
+        with TELEGRAM_REQUEST_SECONDS.time(method=method), self.tracer.span(method):
+            return await self.clients[idx](request)
+
+    async def resolve_peer(self, chat_id, idx):
+        """
+        Input peer чата для аккаунта idx. Для публичных username сначала смотрим в
+        постоянный кэш сущностей и только при промахе делаем ResolveUsername.
+        Возвращает (peer, from_cache).
+        """
+        account = self.accounts[idx]["session"]
+        cached = self.entity_cache.get(chat_id, account)
+        if cached:
+            return InputPeerChannel(cached['id'], cached['access_hash']), True
+        self.tracer.record('rate_limit', await self.rate_limiter.acquire(idx, 'ResolveUsername'))
+        TELEGRAM_REQUESTS.inc(method='ResolveUsername', account=account)
+        with TELEGRAM_REQUEST_SECONDS.time(method='ResolveUsername'), self.tracer.span('ResolveUsername'):
+            entity = await self.clients[idx].get_entity(chat_id)
+        if isinstance(entity, Channel) and entity.access_hash is not None:
+            self.entity_cache.set(chat_id, account, entity.id, entity.access_hash)
+        return get_input_peer(entity), False
+
+    def _pick_new_proxy(self, old_proxy):
+        """
+        Новый прокси для аккаунта, по возможности отличный от прежнего.
+        Если доступных прокси нет (например, единственный ушёл в карантин), остаётся прежний.
+        """
+        try:
             proxy = self.proxy_pool.get_proxy()
+            for _ in range(5):
+                if proxy != old_proxy:
+                    break
+                proxy = self.proxy_pool.get_proxy()
+        except Exception as e:
+            logger.warning(f"Другого прокси нет ({e}), переподключаюсь через прежний")
+            return old_proxy
+        return proxy
+
+    async def reconnect_client(self, idx, new_proxy=False):
+        """
+        Переподключает только клиента аккаунта idx. За аккаунтом закреплён прокси:
+        он сохраняется, пока сам не откажет (new_proxy=True — сменить прокси).
+        Session-файл тот же, что и при старте, повторный вход не нужен.
+        """
+        account = self.accounts[idx]
+        async with self.connect_locks[idx]:
+            await self.clients[idx].disconnect()
+            self.connected[idx] = False
+            if new_proxy:
+                self.client_proxies[idx] = self._pick_new_proxy(self.client_proxies[idx])
             # Важно: пересоздаём клиента только после disconnect
-            self.clients[i] = TelegramClient(
-                self.accounts[i]["session"],
-                self.accounts[i]["api_id"],
-                self.accounts[i]["api_hash"],
-                proxy=proxy
-            )
-            await self.clients[i].start()
-            logger.info(f"Переподключение: получен новый IP через прокси для клиента {self.accounts[i]['session']}!")
+            self.clients[idx] = self._create_client(idx, self.client_proxies[idx])
+        if not await self.ensure_connected(idx):
+            return False
+        logger.info(f"Переподключение: клиент {account['session']} подключён{' через новый прокси' if new_proxy else ''}")
+        return True
+
+    async def handle_connection_error(self, idx, error):
+        """Обрыв соединения на аккаунте idx: прокси уходит в карантин, переподключается только этот клиент"""
+        logger.warning(f"Ошибка соединения у {self.accounts[idx]['session']}: {error}. Переподключаю через другой прокси")
+        if self.client_proxies[idx]:
+            self.proxy_pool.report_failure(self.client_proxies[idx])
+        return await self.reconnect_client(idx, new_proxy=True)
+
+    async def restart_with_new_ip(self):
+        """Переподключение всех клиентов с новыми IP (параллельно)"""
+        await asyncio.gather(*(self.reconnect_client(idx, new_proxy=True) for idx in range(len(self.clients))))
+
+    async def get_chat_info(self, chat_id, account_idx=None, allow_stale=True):
+        """
+        Информация о чате из кэша с учётом сроков жизни полей (FIELD_TTLS).
+        Свежие данные отдаются сразу; устаревшие — тоже сразу, а обновляются
+        в фоне свободным аккаунтом; просроченные или отсутствующие — запрашиваются.
+        """
+        status, cached_data = self.cache.get_fields(chat_id)
+        # Один счётчик на обращение; всё, что приходится запрашивать заново, — промах
+        served = status == 'fresh' or (status == 'stale' and allow_stale)
+        CACHE_LOOKUPS.inc(result=status if served else 'miss')
+        if status == 'fresh':
+            logger.info(f"Используем кэшированные данные для {chat_id}")
+            return cached_data
+        if status == 'stale' and allow_stale:
+            logger.info(f"Кэш для {chat_id} устарел: отдаю как есть и обновляю в фоне")
+            self.schedule_refresh(chat_id)
+            return cached_data
+        return await self.fetch_chat_info(chat_id, account_idx)
+
+    def schedule_refresh(self, chat_id):
+        """Ставит чат в очередь фонового обновления кэша"""
+        if chat_id in self.refresh_pending:
+            return
+        self.refresh_pending.add(chat_id)
+        self.refresh_queue.put_nowait(chat_id)
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.ensure_future(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        """
+        Обновляет устаревшие записи кэша, занимая только простаивающие аккаунты.
+        Накопившиеся в очереди чаты сначала обновляются пакетно (prefetch_channel_info),
+        по одному запрашиваются только те, кому нужен GetFullChannelRequest.
+        """
+        while not self.refresh_queue.empty():
+            batch = [self.refresh_queue.get_nowait()]
+            while not self.refresh_queue.empty() and len(batch) < max(CHANNEL_BATCH_SIZE, 1):
+                batch.append(self.refresh_queue.get_nowait())
+            idx = self.scheduler.try_acquire()
+            while idx is None:
+                await asyncio.sleep(REFRESH_IDLE_POLL)
+                idx = self.scheduler.try_acquire()
+            try:
+                if CHANNEL_BATCH_SIZE:
+                    await self.prefetch_channel_info(batch, idx)
+                for chat_id in batch:
+                    await self.fetch_chat_info(chat_id, account_idx=idx)
+            except (AccountUnavailable, NoAccountsAvailable):
+                pass
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления кэша: {e}")
+            finally:
+                await self.scheduler.release(idx)
+                self.refresh_pending.difference_update(batch)
+
+    async def prefetch_chats(self, chat_ids):
+        """
+        Перед прогоном обновляет устаревшие записи кэша пакетами GetChannelsRequest,
+        чтобы при обработке чатов не запрашивать GetFullChannelRequest по одному.
+        input peer есть не у всех аккаунтов, поэтому чаты группируются по первому
+        аккаунту, у которого он уже есть в кэше сущностей; остальные обновятся
+        по одному при обработке. Возвращает число обновлённых чатов.
+        """
+        if not CHANNEL_BATCH_SIZE:
+            return 0
+        groups = {}
+        for chat_id in chat_ids:
+            stale = self.cache.stale_fields(chat_id)
+            if not stale or any(field in stale for field in FULL_ONLY_FIELDS):
+                continue
+            for idx, account in enumerate(self.accounts):
+                if self.scheduler.is_enabled(idx) and self.entity_cache.get(chat_id, account["session"]):
+                    groups.setdefault(idx, []).append(chat_id)
+                    break
+        updated = 0
+        for idx, group in groups.items():
+            try:
+                await self.scheduler.wait_available(idx)
+                updated += await self.prefetch_channel_info(group, idx)
+            except (AccountUnavailable, NoAccountsAvailable):
+                continue
+            except Exception as e:
+                logger.error(f"Ошибка пакетного обновления кэша: {e}")
+        return updated
+
+    async def prefetch_channel_info(self, chat_ids, idx):
+        """
+        Пакетное обновление базовых полей (название, тип, дата создания) и числа
+        участников одним GetChannelsRequest на CHANNEL_BATCH_SIZE каналов. Берутся только
+        чаты с актуальным описанием, у которых input peer аккаунта idx уже есть в кэше
+        сущностей. Если Telegram не прислал participants_count, число участников
+        остаётся устаревшим и дозапрашивается по одному. Возвращает число обновлённых чатов.
+        """
+        account = self.accounts[idx]["session"]
+        chats_by_id = {}
+        for chat_id in chat_ids:
+            stale = self.cache.stale_fields(chat_id)
+            if not stale or any(field in stale for field in FULL_ONLY_FIELDS):
+                continue
+            cached = self.entity_cache.get(chat_id, account)
+            if cached:
+                chats_by_id[cached['id']] = (chat_id, InputChannel(cached['id'], cached['access_hash']))
+        if not chats_by_id:
+            return 0
+        await self.get_client(idx)
+        updated = 0
+        items = list(chats_by_id.values())
+        for start in range(0, len(items), max(CHANNEL_BATCH_SIZE, 1)):
+            chunk = items[start:start + max(CHANNEL_BATCH_SIZE, 1)]
+            try:
+                response = await self._call(idx, GetChannelsRequest([channel for _, channel in chunk]))
+            except FloodWaitError as e:
+                await self.handle_flood_wait(idx, e, idx)
+            except CONNECTION_ERRORS as e:
+                await self.handle_connection_error(idx, e)
+                return updated
+            except Exception as e:
+                # Один недействительный access_hash портит весь пакет — такие чаты обновятся по одному
+                logger.warning(f"Пакетный GetChannelsRequest ({len(chunk)} каналов) не удался: {e}")
+                continue
+            for chat in response.chats:
+                chat_id = chats_by_id.get(chat.id, (None, None))[0]
+                if chat_id is None or not isinstance(chat, Channel):
+                    continue
+                if not username_matches(chat, chat_id):
+                    self.entity_cache.invalidate(chat_id)
+                    continue
+                fields = channel_fields(chat)
+                fields['last_activity'] = datetime.now(timezone.utc).isoformat()
+                fields['account_used'] = account
+                self.cache.set_fields(chat_id, fields)
+                updated += 1
+        logger.info(f"Пакетное обновление кэша: {updated} из {len(chats_by_id)} чатов за {-(-len(items) // max(CHANNEL_BATCH_SIZE, 1))} запрос(ов)")
+        return updated
+
+    async def fetch_chat_info(self, chat_id, account_idx=None, attempt=1):
+        """
+        Запрашивает у Telegram устаревшие поля чата и сохраняет их в кэш.
+        GetFullChannelRequest нужен только для описания и числа участников;
+        если устарели лишь базовые поля, хватает дешёвого GetChannelsRequest.
+        Свежее число участников обычно уже принёс пакетный prefetch_channel_info.
+        """
+        stale = self.cache.stale_fields(chat_id)
+        if not stale:
+            # Уже обновлено (например, пакетно) — запрос не нужен
+            return self.cache.get_fields(chat_id)[1]
+        need_full = any(field in stale for field in FULL_INFO_FIELDS)
+
+        def make_request(peer):
+            if need_full:
+                return GetFullChannelRequest(peer)
+            return GetChannelsRequest([InputChannel(peer.channel_id, peer.access_hash)])
 
-    async def get_chat_info(self, chat_id):
-        import time
         try:
-            cached_data = self.cache.get(chat_id)
-            if cached_data and 'data' in cached_data:
-                logger.info(f"Используем кэшированные данные для {chat_id}")
-                return cached_data['data']
-            else:
-                logger.info(f"Кэш для {chat_id} не содержит 'data', игнорируем кэш.")
-            await asyncio.sleep(10)
-            client, idx = await self.get_next_client()
-            chat = await client.get_entity(chat_id)
-            if isinstance(chat, Channel):
-                await asyncio.sleep(5)
-                full_chat = await client(GetFullChannelRequest(chat))
-                result = {
-                    'title': chat.title,
-                    'description': full_chat.full_chat.about,
-                    'members_count': getattr(full_chat.full_chat, 'participants_count', None),
-                    'is_public': not chat.megagroup,
-                    'date_created': chat.date.isoformat(),
-                    'last_activity': datetime.now(timezone.utc).isoformat(),
-                    'account_used': self.accounts[idx]["session"]
-                }
-                self.cache.set(chat_id, result)
-                return result
+            client, idx = await self.get_client(account_idx)
+            account = self.accounts[idx]["session"]
+            peer, from_cache = await self.resolve_peer(chat_id, idx)
+            if isinstance(peer, InputPeerChannel):
+                try:
+                    response = await self._call(idx, make_request(peer))
+                except PEER_INVALID_ERRORS:
+                    if not from_cache:
+                        raise
+                    # Сохранённый access_hash больше не действителен
+                    self.entity_cache.invalidate(chat_id, account)
+                    peer, from_cache = await self.resolve_peer(chat_id, idx)
+                    response = await self._call(idx, make_request(peer))
+                if need_full:
+                    chat = next(c for c in response.chats if c.id == response.full_chat.id)
+                else:
+                    chat = next(c for c in response.chats if c.id == peer.channel_id)
+                if not isinstance(chat, Channel):
+                    # ChannelForbidden: доступа к каналу больше нет
+                    self.entity_cache.invalidate(chat_id)
+                    logger.error(f"Чат {chat_id} недоступен")
+                    return None
+                if from_cache and not username_matches(chat, chat_id):
+                    # Username сменил владельца: кэш указывает на другой канал
+                    logger.info(f"Username {chat_id} больше не принадлежит каналу {chat.id}, разрешаю заново")
+                    self.entity_cache.invalidate(chat_id)
+                    self.watermarks.drop(chat_id)
+                    return await self.fetch_chat_info(chat_id, account_idx, attempt)
+                result = channel_fields(chat)
+                if need_full:
+                    result['description'] = response.full_chat.about
+                    result['members_count'] = getattr(response.full_chat, 'participants_count', None)
+                result['last_activity'] = datetime.now(timezone.utc).isoformat()
+                result['account_used'] = account
+                return self.cache.set_fields(chat_id, result)
         except FloodWaitError as e:
-            wait_time = e.seconds
-            logger.warning(f"⚠️ FloodWait: аккаунт {self.accounts[self.current_client_index-1]['session']} заморожен на {wait_time} секунд (чат {chat_id})")
-            self.floodwait_until[self.current_client_index-1] = time.time() + wait_time
-            return await self.get_chat_info(chat_id)
+            await self.handle_flood_wait(idx, e, account_idx, chat_id)
+            return await self.fetch_chat_info(chat_id, account_idx, attempt)
+        except (AccountUnavailable, NoAccountsAvailable):
+            raise
+        except CONNECTION_ERRORS as e:
+            await self.handle_connection_error(idx, e)
+            if attempt >= CONNECTION_RETRIES:
+                logger.error(f"Не удалось получить информацию о чате {chat_id}: соединение обрывается {attempt} раз(а) подряд")
+                return None
+            return await self.fetch_chat_info(chat_id, account_idx, attempt + 1)
+        except PEER_INVALID_ERRORS as e:
+            self.entity_cache.invalidate(chat_id)
+            logger.error(f"Чат {chat_id} недоступен: {e}")
+            return None
         except Exception as e:
             logger.error(f"Ошибка при получении информации о чате {chat_id}: {e}")
             return None
 
-    async def analyze_dau(self, chat_id, hours=24):
-        import time
+    async def analyze_activity(self, chat_id, hours=24, days=30, limit=3000, account_idx=None, incremental=True, attempt=1):
+        """
+        Один проход по истории чата: активность за последние `hours` часов
+        и средний DAU за `days` дней.
+        При incremental=True догружаются только сообщения новее водяного знака чата,
+        а сохранённое окно предыдущего анализа сливается с новыми данными.
+        """
+        from_cache = False
         try:
-            client, idx = await self.get_next_client()
-            messages = []
-            async for message in client.iter_messages(chat_id, limit=100):
-                if message.date > datetime.now(timezone.utc) - timedelta(hours=hours):
-                    messages.append(message)
+            client, idx = await self.get_client(account_idx)
+            peer, from_cache = await self.resolve_peer(chat_id, idx)
+            stats = ActivityStats(hours=hours, days=days)
+            watermark = self.watermarks.get(chat_id) if incremental else None
+            if watermark and not stats.covers(watermark):
+                # Прошлый проход упёрся в лимит, не дойдя до начала окна: такое окно
+                # не склеивается, история читается заново (и при нужде — выборка DAU)
+                logger.info(f"Сохранённое окно {chat_id} неполное, окно собирается заново")
+                watermark = None
+            min_id = watermark['last_id'] if watermark else 0
+            scan = self._scan_history_raw if HISTORY_SCANNER == 'raw' else self._scan_history_iter
+            started = time.perf_counter()
+            fetched = await scan(idx, peer, stats, limit, min_id)
+            elapsed = time.perf_counter() - started
+            logger.info(
+                f"История {chat_id} ({HISTORY_SCANNER}): {fetched} сообщений за {elapsed:.2f} с "
+                f"({fetched / max(elapsed, 1e-9):.0f} сообщ./с)"
+            )
+            stats.finish(exhausted=fetched < limit)
+            if watermark:
+                if fetched < limit:
+                    stats.merge_state(watermark)
+                    logger.info(f"Инкрементальный анализ {chat_id}: новых сообщений {fetched} (после id {min_id})")
                 else:
-                    break
-            unique_senders = set()
-            for msg in messages:
-                if hasattr(msg.from_id, 'user_id'):
-                    unique_senders.add(msg.from_id.user_id)
-            return {
-                'total_messages': len(messages),
-                'unique_senders': len(unique_senders),
-                'time_period': f'Последние {hours} часов',
-                'account_used': self.accounts[idx]["session"]
-            }
+                    # Новых сообщений больше лимита — между ними и водяным знаком разрыв,
+                    # старое окно не склеивается с новым
+                    logger.info(f"Водяной знак {chat_id} устарел, окно собрано заново")
+            self.watermarks.set(chat_id, stats.to_state())
+            result = stats.result()
+            if MESSAGE_COUNT_MODE == 'estimate' and not stats.complete and isinstance(peer, InputPeerChannel):
+                # Проход упёрся в лимит, не дочитав окно: объём за 30 дней оцениваем по id.
+                # Если окно прочитано целиком, точные счётчики есть и лишние запросы не нужны
+                volume = await self.estimate_message_volume(idx, peer, hours, days)
+                result['messages_30d'] = volume['messages_window']
+                if stats.oldest_ts is not None and stats.oldest_ts > stats.recent_since_ts:
+                    # Лимит не покрыл даже последние `hours` часов — точный счётчик занижен.
+                    # Иначе он точнее оценки по id, в которую входят удалённые и служебные сообщения
+                    result['total_messages'] = volume['messages_recent']
+            if DAU_SAMPLES and not stats.complete and isinstance(peer, InputPeerChannel):
+                # Лимит истории покрыл лишь часть окна — средний DAU по нему нерепрезентативен
+                sample = await self.sample_daily_activity(idx, peer, days)
+                if sample['avg_dau'] is not None:
+                    logger.info(
+                        f"DAU {chat_id} по выборке из {sample['samples']} точек: {sample['avg_dau']} "
+                        f"(95% ДИ {sample['avg_dau_ci']})"
+                    )
+                    result['avg_dau'] = sample['avg_dau']
+                    result['avg_dau_ci'] = sample['avg_dau_ci']
+                    result['days_with_messages'] = max(result['days_with_messages'], round(sample['active_share'] * days))
+                    result['avg_dau_method'] = 'sampling'
+            result['account_used'] = self.accounts[idx]["session"]
+            return result
         except FloodWaitError as e:
-            wait_time = e.seconds
-            logger.warning(f"⚠️ FloodWait: аккаунт {self.accounts[self.current_client_index-1]['session']} заморожен на {wait_time} секунд")
-            self.floodwait_until[self.current_client_index-1] = time.time() + wait_time
-            return await self.analyze_dau(chat_id, hours)
+            await self.handle_flood_wait(idx, e, account_idx, chat_id)
+            return await self.analyze_activity(chat_id, hours, days, limit, account_idx, incremental, attempt)
+        except (AccountUnavailable, NoAccountsAvailable):
+            raise
+        except CONNECTION_ERRORS as e:
+            await self.handle_connection_error(idx, e)
+            if attempt >= CONNECTION_RETRIES:
+                logger.error(f"Ошибка при анализе активности чата {chat_id}: соединение обрывается {attempt} раз(а) подряд")
+                return None
+            return await self.analyze_activity(chat_id, hours, days, limit, account_idx, incremental, attempt + 1)
+        except PEER_INVALID_ERRORS as e:
+            if from_cache and self.entity_cache.invalidate(chat_id, self.accounts[idx]["session"]):
+                return await self.analyze_activity(chat_id, hours, days, limit, account_idx, incremental, attempt)
+            logger.error(f"Чат {chat_id} недоступен: {e}")
+            return None
         except Exception as e:
-            print(f"Ошибка при анализе DAU: {e}")
+            logger.error(f"Ошибка при анализе активности чата {chat_id}: {e}")
             return None
 
-    async def analyze_dau_monthly(self, chat_id, days=30):
-        import time
-        try:
-            client, idx = await self.get_next_client()
-            from collections import defaultdict
-            messages_by_day = defaultdict(set)
-            days_with_messages = set()
-            async for message in client.iter_messages(chat_id, limit=3000):
-                if message.date > datetime.now(timezone.utc) - timedelta(days=days):
-                    day = message.date.date()
-                    days_with_messages.add(day)
-                    if hasattr(message.from_id, 'user_id'):
-                        messages_by_day[day].add(message.from_id.user_id)
-                else:
+    async def _scan_history_iter(self, idx, peer, stats, limit, min_id=0):
+        """Проход по истории через iter_messages (полные объекты Message). Возвращает число полученных сообщений"""
+        fetched = 0
+        account = self.accounts[idx]["session"]
+        # iter_messages запрашивает историю страницами по 100 сообщений
+        self.tracer.record('rate_limit', await self.rate_limiter.acquire(idx, 'GetHistoryRequest'))
+        TELEGRAM_REQUESTS.inc(method='GetHistoryRequest', account=account)
+        with self.tracer.span('iter_messages') as span:
+            async for message in self.clients[idx].iter_messages(peer, limit=limit, min_id=min_id):
+                fetched += 1
+                if not stats.add(message.date, get_sender_id(message), message.id):
                     break
-            if not messages_by_day:
-                return {'avg_dau': None, 'avg_dau_percent': None, 'days_with_messages': 0}
-            daily_counts = [len(users) for users in messages_by_day.values()]
-            avg_dau = round(sum(daily_counts) / len(daily_counts), 2)
-            return {
-                'avg_dau': avg_dau,
-                'days_counted': len(daily_counts),
-                'days_with_messages': len(days_with_messages),
-                'account_used': self.accounts[idx]["session"]
-            }
-        except FloodWaitError as e:
-            wait_time = e.seconds
-            logger.warning(f"⚠️ FloodWait: аккаунт {self.accounts[self.current_client_index-1]['session']} заморожен на {wait_time} секунд")
-            self.floodwait_until[self.current_client_index-1] = time.time() + wait_time
-            return await self.analyze_dau_monthly(chat_id, days)
-        except Exception as e:
-            print(f"Ошибка при анализе DAU за месяц: {e}")
+                if fetched % 100 == 0:
+                    self.tracer.record('rate_limit', await self.rate_limiter.acquire(idx, 'GetHistoryRequest'))
+                    TELEGRAM_REQUESTS.inc(method='GetHistoryRequest', account=account)
+            span['messages'] = fetched
+        return fetched
+
+    async def _scan_history_raw(self, idx, peer, stats, limit, min_id=0):
+        """
+        Проход по истории сырыми запросами messages.GetHistory: из каждой страницы
+        берутся только id, дата и отправитель, без сборки Message и разрешения сущностей.
+        Останавливается на границе окна ActivityStats. Возвращает число полученных сообщений.
+        """
+        fetched = 0
+        offset_id = 0
+        while fetched < limit:
+            page_size = min(100, limit - fetched)
+            history = await self._call(idx, GetHistoryRequest(
+                peer=peer, offset_id=offset_id, offset_date=None, add_offset=0,
+                limit=page_size, max_id=0, min_id=min_id, hash=0
+            ))
+            ids, dates, senders = compact_history(history.messages)
+            if not ids:
+                break
+            for message_id, ts, sender_id in zip(ids, dates, senders):
+                fetched += 1
+                if not stats.add_ts(ts, sender_id or None, message_id):
+                    return fetched
+            if len(history.messages) < page_size:
+                break
+            offset_id = ids[-1]
+        return fetched
+
+    async def _message_id_before(self, idx, peer, offset_date=None):
+        """id самого нового сообщения старше offset_date (или просто самого нового); 0, если таких нет"""
+        history = await self._call(idx, GetHistoryRequest(
+            peer=peer, offset_id=0, offset_date=offset_date, add_offset=0,
+            limit=1, max_id=0, min_id=0, hash=0
+        ))
+        return history.messages[0].id if history.messages else 0
+
+    async def estimate_message_volume(self, idx, peer, hours=24, days=30):
+        """
+        Оценка числа сообщений за `hours` часов и `days` дней по разнице id.
+        В каналах и супергруппах id сообщений идут подряд в пределах чата, поэтому
+        хватает трёх запросов: самое новое сообщение и сообщения на границах окон.
+        Удалённые и служебные сообщения тоже занимают id, так что это оценка сверху.
+        """
+        now = datetime.now(timezone.utc)
+        newest_id = await self._message_id_before(idx, peer)
+        id_recent = await self._message_id_before(idx, peer, now - timedelta(hours=hours))
+        id_window = await self._message_id_before(idx, peer, now - timedelta(days=days))
+        return {
+            'newest_id': newest_id,
+            'messages_recent': max(newest_id - id_recent, 0),
+            'messages_window': max(newest_id - id_window, 0),
+        }
+
+    async def sample_daily_activity(self, idx, peer, days=30, samples=DAU_SAMPLES, page_size=DAU_SAMPLE_PAGE,
+                                    max_pages=DAU_SAMPLE_MAX_PAGES):
+        """
+        Стратифицированная по времени выборка для очень больших чатов: окно в `days`
+        дней делится на `samples` равных интервалов, в середине каждого история
+        читается назад от точки (offset_date), пока не покроет предшествующие сутки,
+        но не больше `max_pages` страниц. По прочитанному считается (или, если сутки
+        не покрыты, экстраполируется) число уникальных отправителей за эти сутки.
+        Бюджет — не больше `samples * max_pages` запросов независимо от размера чата.
+        """
+        now = datetime.now(timezone.utc)
+        step = timedelta(days=days) / samples
+        estimates = []
+        active = 0
+        for k in range(samples):
+            until = now - step * (k + 0.5)
+            until_ts = int(until.timestamp())
+            dates, senders = array('q'), array('q')
+            offset_id = 0
+            complete = False
+            for _ in range(max(max_pages, 1)):
+                history = await self._call(idx, GetHistoryRequest(
+                    peer=peer, offset_id=offset_id, offset_date=None if offset_id else until, add_offset=0,
+                    limit=page_size, max_id=0, min_id=0, hash=0
+                ))
+                page_ids, page_dates, page_senders = compact_history(history.messages)
+                dates.extend(page_dates)
+                senders.extend(page_senders)
+                if len(history.messages) < page_size:
+                    complete = True
+                    break
+                if not page_ids or page_dates[-1] <= until_ts - 86400:
+                    break
+                offset_id = page_ids[-1]
+            estimate, has_messages = estimate_sample_dau(dates, senders, until_ts, complete=complete)
+            estimates.append(estimate)
+            active += has_messages
+        avg_dau, (low, high) = summarize_samples(estimates)
+        return {
+            'avg_dau': round(avg_dau, 2) if avg_dau is not None else None,
+            'avg_dau_ci': (round(low, 2), round(high, 2)) if low is not None else None,
+            'active_share': active / samples if samples else 0,
+            'samples': samples,
+        }
+
+    async def analyze_dau(self, chat_id, hours=24):
+        activity = await self.analyze_activity(chat_id, hours=hours)
+        if not activity:
+            return None
+        return {
+            'total_messages': activity['total_messages'],
+            'unique_senders': activity['unique_senders'],
+            'time_period': activity['time_period'],
+            'account_used': activity['account_used']
+        }
+
+    async def analyze_dau_monthly(self, chat_id, days=30):
+        activity = await self.analyze_activity(chat_id, days=days)
+        if not activity or not activity['days_with_messages']:
             return {'avg_dau': None, 'avg_dau_percent': None, 'days_with_messages': 0}
+        return {
+            'avg_dau': activity['avg_dau'],
+            'days_counted': activity['days_counted'],
+            'days_with_messages': activity['days_with_messages'],
+            'account_used': activity['account_used']
+        }
 
     async def generate_report(self, chat_id):
         """Генерация полного отчета"""
@@ -294,50 +857,82 @@ def extract_username(chat_id):
         return chat_id[1:]
     return chat_id
 
+def write_report(rows, filename):
+    """Потоковая запись строк (любой итерируемый объект) в отчёт; возвращает путь или None"""
+    with ReportSink(filename) as sink:
+        sink.write_many(rows)
+    return filename if sink.rows else None
+
 def save_partial_report(results):
     """Сохранение промежуточных результатов анализа"""
-    if not results:
-        logger.warning("Нет данных для сохранения")
-        return
-        
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f'telegram_analysis_partial_{timestamp}.xlsx'
-    
+    filename = f'telegram_analysis_partial_{timestamp}.{REPORT_FORMAT}'
+
     try:
-        df = pd.DataFrame(results)
-        df.to_excel(filename, index=False)
-        logger.info(f'Промежуточные результаты сохранены в файл: {filename}')
+        if write_report(results, filename):
+            logger.info(f'Промежуточные результаты сохранены в файл: {filename}')
+        else:
+            logger.warning("Нет данных для сохранения")
     except Exception as e:
         logger.error(f'Ошибка при сохранении промежуточных результатов: {e}')
 
 def save_report(results):
-    """Сохранение полного отчета в Excel"""
-    if not results:
-        print('Нет данных для сохранения.')
-        return
-    df = pd.DataFrame(results)
+    """Сохранение полного отчета"""
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f'report_{timestamp}.xlsx'
-    df.to_excel(filename, index=False)
-    print(f'Отчет сохранен в файле {filename}')
+    filename = f'report_{timestamp}.{REPORT_FORMAT}'
+    if write_report(results, filename):
+        print(f'Отчет сохранен в файле {filename}')
+    else:
+        print('Нет данных для сохранения.')
 
 def save_last_24h_results(results):
     """Сохранение результатов анализа за последние 24 часа"""
-    if not results:
-        logger.warning("Нет данных для сохранения")
-        return
-        
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f'last_24h_analysis_{timestamp}.xlsx'
-    
+    filename = f'last_24h_analysis_{timestamp}.{REPORT_FORMAT}'
+
     try:
-        df = pd.DataFrame(results)
-        df.to_excel(filename, index=False)
-        logger.info(f'Результаты анализа за последние 24 часа сохранены в файл: {filename}')
-        print(f'\nРезультаты сохранены в файл: {filename}')
+        if write_report(results, filename):
+            logger.info(f'Результаты анализа за последние 24 часа сохранены в файл: {filename}')
+            print(f'\nРезультаты сохранены в файл: {filename}')
+        else:
+            logger.warning("Нет данных для сохранения")
     except Exception as e:
         logger.error(f'Ошибка при сохранении результатов: {e}')
 
+def add_report_row(analyzer, row):
+    """Дописывает чат в отчёт запуска и время от времени обновляет его снимок"""
+    if analyzer.report is None:
+        return
+    try:
+        analyzer.report.write(row)
+        if REPORT_SNAPSHOT_EVERY and analyzer.report.rows % REPORT_SNAPSHOT_EVERY == 0:
+            path = analyzer.report.snapshot()
+            logger.info(f"Снимок отчёта обновлён: {path} ({analyzer.report.rows} чатов)")
+    except Exception as e:
+        logger.error(f"Ошибка записи в отчёт: {e}")
+
+def quality_properties(analysis_results):
+    """Свойства ML-оценки (Prediction, Quality Probability) по уже посчитанным метрикам чата"""
+    return prediction_properties(*predict_quality(analysis_metrics(analysis_results)))
+
+async def write_chat_page(analyzer, chat_id, page_id, properties, stages, data=None):
+    """
+    Ставит полный набор свойств страницы в очередь записи в Notion (один pages.update).
+    Этапы журнала stages фиксируются, когда запись действительно прошла.
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_done(error):
+        if error is None:
+            loop.call_soon_threadsafe(record_stages, analyzer.journal, chat_id, page_id, stages, data)
+
+    # Если очередь полна, ждём в пуле потоков, не блокируя event loop
+    await run_blocking(analyzer.writer.submit, page_id, properties, on_done)
+
+def record_stages(journal, chat_id, page_id, stages, data=None):
+    for stage in stages:
+        journal.record(chat_id, stage, data if stage == 'written' else None, page_id)
+
 def get_resume(members, avg_dau, avg_dau_percent, days_with_messages, days_in_month=30):
     if members is None or pd.isna(members):
         return 'нет данных'
@@ -369,8 +964,237 @@ def get_resume(members, avg_dau, avg_dau_percent, days_with_messages, days_in_mo
         else:
             return 'Живой чат'
 
+async def run_blocking(func, *args, **kwargs):
+    """Запуск синхронного вызова (Notion, ML-модель) в пуле потоков, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+def page_chat_id(chat_page):
+    """id чата из свойства «Канал/чат» страницы Notion (пустая строка, если его нет)"""
+    rich_text = chat_page.get("properties", {}).get("Канал/чат", {}).get("rich_text", [])
+    return rich_text[0].get("text", {}).get("content", "") if rich_text else ""
+
+async def process_chat(analyzer, chat_page, account_idx=None):
+    """
+    Полный анализ одного чата из очереди Notion: метрики Telegram, запись в Notion и ML-оценка.
+    Возвращает 'analyzed', 'error' или 'skipped'.
+    """
+    chat_id = page_chat_id(chat_page)
+    if not chat_id:
+        logger.warning("[DEBUG] Пропущен чат без chat_id")
+        return 'skipped'
+    with analyzer.tracer.trace(chat_id) as trace:
+        try:
+            trace['status'] = await analyze_chat(analyzer, chat_id, chat_page["id"], account_idx)
+        except AccountUnavailable:
+            trace['status'] = 'requeued'
+            raise
+        except Exception:
+            trace['status'] = 'exception'
+            raise
+    return trace['status']
+
+async def analyze_chat(analyzer, chat_id, page_id, account_idx=None):
+    """Этапы обработки чата с учётом журнала прогона; возвращает 'analyzed' или 'error'"""
+    journal = analyzer.journal
+    tracer = analyzer.tracer
+    if journal.is_done(chat_id, 'written'):
+        # Метрики уже в Notion — после перезапуска осталось только оценить чат
+        logger.info(f"[DEBUG] {chat_id}: метрики записаны в прошлом запуске, выполняю только ML-оценку")
+        await score_chat(analyzer, chat_id)
+        return 'analyzed'
+    logger.info(f"[DEBUG] Начинаю анализ чата {chat_id}")
+    print(f"[DEBUG] Анализирую чат: {chat_id}")
+
+    # Получаем информацию о чате
+    chat_info = journal.data(chat_id, 'resolved')
+    if chat_info is None:
+        with tracer.span('get_chat_info'):
+            chat_info = await analyzer.get_chat_info(chat_id, account_idx=account_idx)
+        if chat_info:
+            journal.record(chat_id, 'resolved', chat_info, page_id)
+    if not chat_info:
+        logger.warning(f"Ошибка анализа чата {chat_id}, устанавливаю статус Error в Notion")
+        error_results = {"chat_id": chat_id, "name": ""}
+        logger.warning(f"Ставлю в очередь записи в Notion: {error_results}")
+        await write_chat_page(
+            analyzer, chat_id, page_id, analyzer.notion.analysis_properties(error_results, status="Error"), ['failed']
+        )
+        add_report_row(analyzer, {**error_results, "status": "Error"})
+        return 'error'
+
+    # Анализируем DAU за 24 часа и за месяц одним проходом по истории
+    activity = journal.data(chat_id, 'fetched')
+    if activity is None:
+        with tracer.span('analyze_activity'):
+            activity = await analyzer.analyze_activity(chat_id, account_idx=account_idx)
+        if activity:
+            journal.record(chat_id, 'fetched', activity, page_id)
+    if not activity:
+        logger.warning(f"Ошибка анализа DAU для чата {chat_id}, устанавливаю статус Error в Notion")
+        error_results = {"chat_id": chat_id, "name": chat_info.get('title', '') if chat_info else ""}
+        logger.warning(f"Ставлю в очередь записи в Notion: {error_results}")
+        await write_chat_page(
+            analyzer, chat_id, page_id, analyzer.notion.analysis_properties(error_results, status="Error"), ['failed']
+        )
+        add_report_row(analyzer, {**error_results, "status": "Error"})
+        return 'error'
+
+    # Формируем результаты анализа для всех полей
+    members_count = chat_info.get("members_count", 0)
+    dau = activity.get("unique_senders", 0)
+    dau_percent = round((dau / members_count * 100), 2) if members_count and dau is not None else 0
+    monthly_avg_dau = activity.get("avg_dau", 0)
+    monthly_avg_dau_percent = round((monthly_avg_dau / members_count * 100), 2) if members_count and monthly_avg_dau is not None else 0
+    days_with_messages = activity.get("days_with_messages", 0)
+    total_messages = activity.get("total_messages", 0)
+    resume = get_resume(members_count, monthly_avg_dau, monthly_avg_dau_percent, days_with_messages)
+    cache_date = datetime.now().isoformat()
+    account_used = chat_info.get("account_used", "")
+    description = chat_info.get("description", "")
+    name = chat_info.get("title", "")
+
+    analysis_results = {
+        "chat_id": chat_id,
+        "name": name,
+        "description": description,
+        "members_count": members_count,
+        "dau": dau,
+        "dau_percent": dau_percent,
+        "monthly_avg_dau": monthly_avg_dau,
+        "monthly_avg_dau_percent": monthly_avg_dau_percent,
+        "days_with_messages": days_with_messages,
+        "total_messages": total_messages,
+        "messages_30d": activity.get("messages_30d"),
+        "resume": resume,
+        "cache_date": cache_date,
+        "account": account_used,
+        "activity_score": monthly_avg_dau_percent,
+        "notes": f"DAU за 24 часа: {dau}\n"
+                f"DAU за месяц: {monthly_avg_dau}\n"
+                f"Процент DAU: {monthly_avg_dau_percent}%"
+    }
+
+    # Метрики и ML-оценка по ним уходят в Notion одним pages.update
+    properties = analyzer.notion.analysis_properties(analysis_results)
+    stages = ['written']
+    try:
+        print(f"Выполняю ML-оценку для {chat_id}")
+        with tracer.span('evaluate_chat'):
+            properties.update(await run_blocking(quality_properties, analysis_results))
+        stages.append('scored')
+    except Exception as e:
+        # Метрики всё равно записываем; оценку доделает resume_unscored при следующем запуске
+        print(f"Ошибка ML-оценки для {chat_id}: {e}")
+        logger.error(f"Ошибка ML-оценки для {chat_id}: {e}")
+
+    with tracer.span('notion_write_queue'):
+        await write_chat_page(analyzer, chat_id, page_id, properties, stages, analysis_results)
+    add_report_row(analyzer, {**analysis_results, "status": "Analyzed"})
+    logger.info(f"[DEBUG] Метрики для {chat_id} поставлены в очередь записи в Notion")
+    return 'analyzed'
+
+async def score_chat(analyzer, chat_id):
+    """ML-оценка чата; успешная оценка завершает чат в журнале прогона"""
+    try:
+        print(f"Выполняю ML-оценку для {chat_id}")
+        with analyzer.tracer.span('evaluate_chat'):
+            await run_blocking(evaluate_chat, chat_id)
+        analyzer.journal.record(chat_id, 'scored')
+        print(f"ML-оценка для {chat_id} завершена успешно")
+        logger.info(f"ML-оценка для {chat_id} завершена успешно")
+    except Exception as e:
+        print(f"Ошибка ML-оценки для {chat_id}: {e}")
+        logger.error(f"Ошибка ML-оценки для {chat_id}: {e}")
+
+async def resume_unscored(analyzer):
+    """
+    Чаты, записанные в Notion, но не оценённые до падения прошлого запуска,
+    уже не имеют статуса 'To Analyze' — доделываем их по журналу
+    """
+    for chat_id, page_id, _ in analyzer.journal.pending('written'):
+        logger.info(f"Журнал прогона: доделываю ML-оценку {chat_id}")
+        await score_chat(analyzer, chat_id)
+
+async def run_sequential(analyzer, chats_to_analyze):
+    """Последовательный анализ: один чат за раз, аккаунты чередуются"""
+    await analyzer.prefetch_chats([page_chat_id(chat_page) for chat_page in chats_to_analyze])
+    for chat_page in chats_to_analyze:
+        status = await process_chat(analyzer, chat_page)
+        if status == 'skipped':
+            continue
+        # Делаем паузу между анализами
+        with analyzer.tracer.span('cooldown'):
+            await asyncio.sleep(random.uniform(*CHAT_COOLDOWN))
+
+async def run_worker_pool(analyzer, chats_to_analyze, workers=None):
+    """
+    Параллельный анализ: воркеры берут чаты из общей очереди и на время обработки
+    чата захватывают аккаунт у планировщика. Аккаунты в FloodWait планировщик
+    не выдаёт, поэтому пропускная способность растёт с числом аккаунтов.
+    """
+    await analyzer.prefetch_chats([page_chat_id(chat_page) for chat_page in chats_to_analyze])
+    queue = asyncio.Queue()
+    for chat_page in chats_to_analyze:
+        queue.put_nowait(chat_page)
+
+    workers = min(workers or len(analyzer.clients), len(analyzer.clients))
+    stats = {idx: {'analyzed': 0, 'error': 0, 'skipped': 0, 'busy': 0.0} for idx in range(len(analyzer.clients))}
+    run_started = time.time()
+
+    async def worker():
+        while True:
+            try:
+                chat_page = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                waiting = time.perf_counter()
+                idx, flood_wait = await analyzer.scheduler.acquire_timed()
+                analyzer.tracer.record('flood_wait', flood_wait)
+                analyzer.tracer.record('wait_account', time.perf_counter() - waiting - flood_wait)
+            except NoAccountsAvailable:
+                logger.error("Воркер остановлен: не осталось доступных аккаунтов")
+                return
+            started = time.time()
+            try:
+                status = await process_chat(analyzer, chat_page, account_idx=idx)
+            except AccountUnavailable:
+                # FloodWait уже учтён планировщиком — чат вернётся в очередь для другого аккаунта
+                queue.put_nowait(chat_page)
+                await analyzer.scheduler.release(idx)
+                continue
+            except Exception as e:
+                logger.error(f"Воркер {analyzer.accounts[idx]['session']}: необработанная ошибка: {e}")
+                status = 'error'
+            stats[idx][status] += 1
+            stats[idx]['busy'] += time.time() - started
+            # Пауза между чатами на одном аккаунте
+            cooldown = random.uniform(*CHAT_COOLDOWN) if status != 'skipped' else 0
+            await analyzer.scheduler.release(idx, cooldown=cooldown)
+
+    logger.info(f"Запускаю пул из {workers} воркеров для {len(chats_to_analyze)} чатов")
+    await asyncio.gather(*(worker() for _ in range(workers)))
+
+    elapsed_hours = max(time.time() - run_started, 1e-9) / 3600
+    total = 0
+    for idx, account_stats in stats.items():
+        done = account_stats['analyzed'] + account_stats['error']
+        if not done:
+            continue
+        total += done
+        logger.info(
+            f"Аккаунт {analyzer.accounts[idx]['session']}: обработано {done} "
+            f"(успешно {account_stats['analyzed']}, ошибок {account_stats['error']}), "
+            f"{done / elapsed_hours:.1f} чатов/час, в работе {account_stats['busy']:.0f} с"
+        )
+    logger.info(f"Итого: {total} чатов, {total / elapsed_hours:.1f} чатов/час")
+    return stats
+
 async def main():
+    metrics_server = start_http_server(METRICS_PORT) if METRICS_PORT else None
     analyzer = TelegramAnalyzer()
+    analyzer.report = ReportSink(f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{REPORT_FORMAT}", columns=REPORT_COLUMNS)
     await analyzer.start()
     
     try:
@@ -384,98 +1208,44 @@ async def main():
         
         print(f"Готов к анализу чатов, всего в очереди: {len(chats_to_analyze)}")
         logger.info(f"Готов к анализу чатов, всего в очереди: {len(chats_to_analyze)}")
-        
-        for chat_page in chats_to_analyze:
-            chat_properties = chat_page.get("properties", {})
-            chat_id_property = chat_properties.get("Канал/чат", {})
-            rich_text = chat_id_property.get("rich_text", [])
-            chat_id = rich_text[0].get("text", {}).get("content", "") if rich_text else ""
-            if not chat_id:
-                logger.warning("[DEBUG] Пропущен чат без chat_id")
-                    continue
-            logger.info(f"[DEBUG] Начинаю анализ чата {chat_id}")
-            print(f"[DEBUG] Анализирую чат: {chat_id}")
-            
-            # Получаем информацию о чате
-            chat_info = await analyzer.get_chat_info(chat_id)
-                        if not chat_info:
-                logger.warning(f"Ошибка анализа чата {chat_id}, устанавливаю статус Error в Notion")
-                error_results = {"chat_id": chat_id, "name": ""}
-                logger.warning(f"Передаю в update_chat_analysis: {error_results}")
-                analyzer.notion.update_chat_analysis(chat_page["id"], error_results, status="Error")
-                continue
-            
-            # Анализируем DAU
-            dau_info = await analyzer.analyze_dau(chat_id)
-            monthly_dau = await analyzer.analyze_dau_monthly(chat_id)
-            if not dau_info or not monthly_dau:
-                logger.warning(f"Ошибка анализа DAU для чата {chat_id}, устанавливаю статус Error в Notion")
-                error_results = {"chat_id": chat_id, "name": chat_info.get('title', '') if chat_info else ""}
-                logger.warning(f"Передаю в update_chat_analysis: {error_results}")
-                analyzer.notion.update_chat_analysis(chat_page["id"], error_results, status="Error")
-                            continue
-            
-            # Формируем результаты анализа для всех полей
-            members_count = chat_info.get("members_count", 0)
-            dau = dau_info.get("unique_senders", 0) if dau_info else 0
-            dau_percent = round((dau / members_count * 100), 2) if members_count and dau is not None else 0
-            monthly_avg_dau = monthly_dau.get("avg_dau", 0) if monthly_dau else 0
-            monthly_avg_dau_percent = round((monthly_avg_dau / members_count * 100), 2) if members_count and monthly_avg_dau is not None else 0
-            days_with_messages = monthly_dau.get("days_with_messages", 0) if monthly_dau else 0
-            total_messages = dau_info.get("total_messages", 0) if dau_info else 0
-            resume = get_resume(members_count, monthly_avg_dau, monthly_avg_dau_percent, days_with_messages)
-            cache_date = datetime.now().isoformat()
-            account_used = chat_info.get("account_used", "")
-            description = chat_info.get("description", "")
-            name = chat_info.get("title", "")
-
-            analysis_results = {
-                "chat_id": chat_id,
-                "name": name,
-                "description": description,
-                "members_count": members_count,
-                "dau": dau,
-                "dau_percent": dau_percent,
-                "monthly_avg_dau": monthly_avg_dau,
-                "monthly_avg_dau_percent": monthly_avg_dau_percent,
-                "days_with_messages": days_with_messages,
-                "total_messages": total_messages,
-                "resume": resume,
-                "cache_date": cache_date,
-                "account": account_used,
-                "activity_score": monthly_avg_dau_percent,
-                "notes": f"DAU за 24 часа: {dau}\n"
-                        f"DAU за месяц: {monthly_avg_dau}\n"
-                        f"Процент DAU: {monthly_avg_dau_percent}%"
-            }
-            
-            # Обновляем страницу в Notion
-            analyzer.notion.update_chat_analysis(chat_page["id"], analysis_results)
-            logger.info(f"[DEBUG] Метрики для {chat_id} обновлены в Notion")
-            
-            # ML-оценка
-            try:
-                print(f"Выполняю ML-оценку для {chat_id}")
-                evaluate_chat(chat_id)
-                print(f"ML-оценка для {chat_id} завершена успешно")
-                logger.info(f"ML-оценка для {chat_id} завершена успешно")
-                except Exception as e:
-                print(f"Ошибка ML-оценки для {chat_id}: {e}")
-                logger.error(f"Ошибка ML-оценки для {chat_id}: {e}")
-            
-            # Делаем паузу между анализами
-            await asyncio.sleep(random.uniform(5, 10))
+
+        await resume_unscored(analyzer)
+
+        if ANALYSIS_WORKERS > 1:
+            await run_worker_pool(analyzer, chats_to_analyze, workers=ANALYSIS_WORKERS)
+        else:
+            await run_sequential(analyzer, chats_to_analyze)
     
     except Exception as e:
         logger.error(f"Произошла ошибка: {e}")
     finally:
-        # Экспортируем результаты в Excel
-        analyzer.notion.export_to_excel(f"notion_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx")
-        
+        # Дописываем отложенные записи в Notion, пока журнал прогона ещё открыт
+        try:
+            await run_blocking(analyzer.writer.close)
+        except Exception as e:
+            logger.error(f"Ошибка при записи в Notion: {e}")
+
+        # Отчёт запуска писался по мере обработки чатов — осталось собрать итоговый файл
+        try:
+            report_path = analyzer.report.close()
+            if report_path:
+                logger.info(f"Отчёт запуска: {report_path}")
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении отчёта: {e}")
+
         # Закрываем все клиенты
+        analyzer.proxy_pool.stop_health_checks()
+        if analyzer.refresh_task:
+            analyzer.refresh_task.cancel()
+        analyzer.journal.close()
+        analyzer.tracer.close()
+        analyzer.cache.close()
+        analyzer.watermarks.close()
+        analyzer.entity_cache.close()
         for client in analyzer.clients:
             await client.disconnect()
+        if metrics_server:
+            metrics_server.shutdown()
 
 if __name__ == "__main__":
-        asyncio.run(main())
-    
\ No newline at end of file
+    asyncio.run(main())
@@ -1,7 +1,139 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
 from datetime import datetime, timedelta, timezone
- 
+
+logger = logging.getLogger(__name__)
+
+# Срок жизни полей информации о чате; None — поле не устаревает
+FIELD_TTLS = {
+    'title': timedelta(days=30),
+    'description': timedelta(days=30),
+    'is_public': timedelta(days=30),
+    'date_created': None,
+    'members_count': timedelta(days=1),
+}
+# Устаревшее поле отдаётся сразу (с обновлением в фоне), пока его возраст
+# не превысит STALE_FACTOR сроков жизни; после этого запись считается просроченной
+STALE_FACTOR = 3
+
+
 class Cache:
-    def is_expired(self, timestamp):
-        """Проверка срока действия кэша (30 дней)"""
+    """
+    Кэш информации о чатах в SQLite (WAL): одна строка на чат, поиск по первичному
+    ключу, каждая запись — отдельная транзакция. В отличие от JSON-файла запись
+    не переписывает весь кэш, а сбой посреди записи не портит остальные данные.
+    """
+
+    def __init__(self, db_path='chat_cache.db', legacy_json='chat_cache.json'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_cache ("
+            "chat_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at TEXT NOT NULL)"
+        )
+        self.conn.commit()
+        if legacy_json:
+            self._migrate_json(legacy_json)
+
+    def _migrate_json(self, json_path):
+        """Однократный перенос старого chat_cache.json; файл переименовывается в *.migrated"""
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            now = datetime.now(timezone.utc).isoformat()
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO chat_cache (chat_id, data, updated_at) VALUES (?, ?, ?)",
+                    ((chat_id, json.dumps(data, ensure_ascii=False), now) for chat_id, data in legacy.items())
+                )
+            os.replace(json_path, f"{json_path}.migrated")
+            logger.info(f"Кэш из {json_path} перенесён в {self.db_path}: {len(legacy)} записей")
+        except Exception as e:
+            logger.error(f"Ошибка при переносе кэша из {json_path}: {e}")
+
+    def get(self, chat_id):
+        try:
+            with self.lock:
+                row = self.conn.execute("SELECT data FROM chat_cache WHERE chat_id = ?", (chat_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша: {e}")
+            return None
+
+    def set(self, chat_id, data):
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "INSERT INTO chat_cache (chat_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    (chat_id, json.dumps(data, ensure_ascii=False), datetime.now(timezone.utc).isoformat())
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша: {e}")
+
+    def get_fields(self, chat_id):
+        """
+        Данные чата и их свежесть: ('fresh' | 'stale' | 'expired', data).
+        Свежесть записи — худшая из свежестей её полей. Записи старого формата
+        (без времени получения полей) считаются просроченными.
+        """
+        entry = self.get(chat_id)
+        if not entry:
+            return 'expired', None
+        if 'fetched_at' not in entry:
+            return 'expired', entry.get('data', entry)
+        data, fetched_at = entry.get('data', {}), entry['fetched_at']
+        status = 'fresh'
+        for field, ttl in FIELD_TTLS.items():
+            if ttl is None:
+                if field not in fetched_at:
+                    return 'expired', data
+                continue
+            if field not in fetched_at or self.is_expired(fetched_at[field], ttl * STALE_FACTOR):
+                return 'expired', data
+            if self.is_expired(fetched_at[field], ttl):
+                status = 'stale'
+        return status, data
+
+    def stale_fields(self, chat_id):
+        """Поля, срок жизни которых истёк (или которых нет в кэше)"""
+        entry = self.get(chat_id) or {}
+        fetched_at = entry.get('fetched_at', {})
+        return [
+            field for field, ttl in FIELD_TTLS.items()
+            if field not in fetched_at or (ttl is not None and self.is_expired(fetched_at[field], ttl))
+        ]
+
+    def set_fields(self, chat_id, fields):
+        """Обновляет часть полей записи, отмечая время их получения"""
+        entry = self.get(chat_id) or {}
+        if 'fetched_at' not in entry:
+            entry = {'data': {}, 'fetched_at': {}}
+        now = datetime.now(timezone.utc).isoformat()
+        entry['data'].update(fields)
+        entry['fetched_at'].update({field: now for field in fields})
+        self.set(chat_id, entry)
+        return entry['data']
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chat_cache").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def is_expired(self, timestamp, ttl=timedelta(days=30)):
+        """Проверка срока действия кэша (по умолчанию 30 дней)"""
         cache_time = datetime.fromisoformat(timestamp)
-        return datetime.now(timezone.utc) - cache_time > timedelta(days=30) 
\ No newline at end of file
+        if cache_time.tzinfo is None:
+            cache_time = cache_time.replace(tzinfo=timezone.utc)
+        return datetime.now(timezone.utc) - cache_time > ttl
@@ -0,0 +1,27 @@
+import re
+
+USERNAME_RE = re.compile(r'^[a-z][a-z0-9_]{3,31}$')
+LINK_PREFIXES = ('@https://t.me/', 'https://t.me/', 'http://t.me/', 't.me/', 'https://telegram.me/', '@')
+
+
+def normalize_chat_id(chat_id):
+    """
+    Канонический id чата: username в нижнем регистре без @ и ссылки t.me.
+    Поддерживает форматы:
+    - https://t.me/chat_id
+    - t.me/chat_id
+    - @chat_id
+    - chat_id
+    """
+    value = (chat_id or '').strip()
+    for prefix in LINK_PREFIXES:
+        if value.lower().startswith(prefix):
+            value = value[len(prefix):]
+            break
+    value = value.split('?')[0].strip('/')
+    return value.lower()
+
+
+def is_username(value):
+    """Является ли нормализованный id публичным username (а не invite-ссылкой или числом)"""
+    return bool(USERNAME_RE.match(value))
@@ -39,21 +39,12 @@ def check_chat_dau(chat_id):
     Проверяет значения DAU для конкретного чата
     """
     notion = NotionIntegration()
-    response = notion.notion.databases.query(
-        database_id=notion.database_id,
-        filter={
-            "property": "Канал/чат",
-            "rich_text": {
-                "equals": chat_id
-            }
-        }
-    )
+    page = notion.find_chat_page(chat_id)
     
-    if not response.get("results"):
+    if page is None:
         print(f"Чат {chat_id} не найден в базе")
         return
         
-    page = response["results"][0]
     properties = page.get("properties", {})
     
     # Получаем все метрики DAU
@@ -73,21 +64,12 @@ def check_chat_metrics(chat_id):
     Проверяет все важные метрики для конкретного чата
     """
     notion = NotionIntegration()
-    response = notion.notion.databases.query(
-        database_id=notion.database_id,
-        filter={
-            "property": "Канал/чат",
-            "rich_text": {
-                "equals": chat_id
-            }
-        }
-    )
+    page = notion.find_chat_page(chat_id)
     
-    if not response.get("results"):
+    if page is None:
         print(f"Чат {chat_id} не найден в базе")
         return
         
-    page = response["results"][0]
     properties = page.get("properties", {})
     
     # Получаем все важные метрики
@@ -9,10 +9,8 @@ def check_evaluation_status():
     Проверяет статус оценки чатов в базе данных Notion
     """
     notion = NotionIntegration()
-    response = notion.notion.databases.query(
-        database_id=notion.database_id
-    )
-    results = response.get("results", [])
+    # Из Notion запрашиваются только страницы, изменённые с прошлого запуска
+    results = notion.snapshot_pages()
     
     evaluated = 0
     not_evaluated = 0
@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from chat_ids import is_username, normalize_chat_id
+
+logger = logging.getLogger(__name__)
+
+
+class EntityCache:
+    """
+    Постоянный кэш разрешения username → (channel_id, access_hash) по аккаунтам.
+    access_hash у каждого аккаунта свой, поэтому ключ — пара (username, аккаунт).
+    С кэшем input peer строится без запроса ResolveUsername.
+    Хранится в SQLite (WAL), одна строка на пару: запись не переписывает весь кэш.
+    """
+
+    def __init__(self, db_path='entity_cache.db', legacy_json='entity_cache.json'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entities ("
+            "username TEXT NOT NULL, account TEXT NOT NULL, channel_id INTEGER NOT NULL, "
+            "access_hash INTEGER NOT NULL, resolved_at TEXT NOT NULL, PRIMARY KEY (username, account))"
+        )
+        self.conn.commit()
+        if legacy_json:
+            self._migrate_json(legacy_json)
+
+    def _migrate_json(self, json_path):
+        """Однократный перенос старого entity_cache.json; файл переименовывается в *.migrated"""
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+            rows = [
+                (username, account, entry['id'], entry['access_hash'], entry.get('resolved_at', ''))
+                for username, accounts in legacy.items() for account, entry in accounts.items()
+            ]
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO entities (username, account, channel_id, access_hash, resolved_at) "
+                    "VALUES (?, ?, ?, ?, ?)", rows
+                )
+            os.replace(json_path, f"{json_path}.migrated")
+            logger.info(f"Кэш сущностей из {json_path} перенесён в {self.db_path}: {len(rows)} записей")
+        except Exception as e:
+            logger.error(f"Ошибка при переносе кэша сущностей из {json_path}: {e}")
+
+    @staticmethod
+    def key(chat_id):
+        """Ключ кэша или None, если chat_id не публичный username"""
+        username = normalize_chat_id(chat_id)
+        return username if is_username(username) else None
+
+    def get(self, chat_id, account):
+        key = self.key(chat_id)
+        if not key:
+            return None
+        try:
+            with self.lock:
+                row = self.conn.execute(
+                    "SELECT channel_id, access_hash, resolved_at FROM entities WHERE username = ? AND account = ?",
+                    (key, account)
+                ).fetchone()
+        except Exception as e:
+            logger.error(f"Ошибка при чтении кэша сущностей: {e}")
+            return None
+        if not row:
+            return None
+        return {'id': row[0], 'access_hash': row[1], 'resolved_at': row[2]}
+
+    def set(self, chat_id, account, channel_id, access_hash):
+        key = self.key(chat_id)
+        if not key:
+            return
+        try:
+            with self.lock, self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO entities (username, account, channel_id, access_hash, resolved_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, account, channel_id, access_hash, datetime.now(timezone.utc).isoformat())
+                )
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша сущностей: {e}")
+
+    def invalidate(self, chat_id, account=None):
+        """
+        Удаляет запись (для одного аккаунта или для всех).
+        Возвращает True, если было что удалять.
+        """
+        key = self.key(chat_id)
+        if not key:
+            return False
+        try:
+            with self.lock, self.conn:
+                if account is None:
+                    cursor = self.conn.execute("DELETE FROM entities WHERE username = ?", (key,))
+                else:
+                    cursor = self.conn.execute(
+                        "DELETE FROM entities WHERE username = ? AND account = ?", (key, account)
+                    )
+        except Exception as e:
+            logger.error(f"Ошибка при сбросе кэша сущностей: {e}")
+            return False
+        if not cursor.rowcount:
+            return False
+        logger.info(f"Кэш сущностей: запись {key} сброшена")
+        return True
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -11,13 +11,8 @@ def get_all_chats():
     Получает список всех чатов из базы данных Notion
     """
     notion = NotionIntegration()
-    response = notion.notion.databases.query(
-        database_id=notion.database_id
-    )
-    results = response.get("results", [])
-    
     chats = []
-    for page in results:
+    for page in notion.iter_pages():
         properties = page.get("properties", {})
         
         # Безопасное получение chat_id
@@ -60,10 +55,7 @@ def get_not_evaluated_chats():
     Возвращает список неоценённых чатов (Prediction и Quality Probability отсутствуют)
     """
     notion = NotionIntegration()
-    response = notion.notion.databases.query(
-        database_id=notion.database_id
-    )
-    results = response.get("results", [])
+    results = notion.snapshot_pages()
     not_evaluated_chats = []
     for page in results:
         properties = page.get("properties", {})
@@ -90,21 +82,12 @@ def check_chat_metrics(chat_id):
     Проверяет наличие всех необходимых метрик для чата
     """
     notion = NotionIntegration()
-    response = notion.notion.databases.query(
-        database_id=notion.database_id,
-        filter={
-            "property": "Канал/чат",
-            "rich_text": {
-                "equals": chat_id
-            }
-        }
-    )
+    page = notion.find_chat_page(chat_id)
     
-    if not response.get("results"):
+    if page is None:
         logger.error(f"Чат {chat_id} не найден в базе")
         return False
         
-    page = response["results"][0]
     properties = page.get("properties", {})
     
     # Проверяем наличие всех необходимых метрик
@@ -130,24 +113,15 @@ def evaluate_chats_from_list(chat_ids):
     from evaluate_chat import evaluate_chat
     evaluated = []
     skipped = []
+    notion = NotionIntegration()
     for chat_id in chat_ids:
         print(f"\nПробую оценить: {chat_id}")
         # Проверяем наличие базовых метрик
-        notion = NotionIntegration()
-        response = notion.notion.databases.query(
-            database_id=notion.database_id,
-            filter={
-                "property": "Канал/чат",
-                "rich_text": {
-                    "equals": chat_id
-                }
-            }
-        )
-        if not response.get("results"):
+        page = notion.find_chat_page(chat_id)
+        if page is None:
             print(f"Чат {chat_id} не найден в базе")
             skipped.append(chat_id)
             continue
-        page = response["results"][0]
         properties = page.get("properties", {})
         subs = properties.get("Подписчиков", {}).get("number")
         dau = properties.get("DAU", {}).get("number")
@@ -1,40 +1,24 @@
+import functools
 import joblib
 import pandas as pd
 from notion_integration import NotionIntegration
 import logging
 import sys
+from metrics import MODEL_INFERENCE_SECONDS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def evaluate_chat(chat_id):
-    """
-    Оценивает качество чата с помощью предобученной модели
-    """
-    # Загружаем модель
-    model = joblib.load('final_leadl_chat_quality_model.pkl')
-    
-    # Получаем метрики чата из Notion
-    notion = NotionIntegration()
-    response = notion.notion.databases.query(
-        database_id=notion.database_id,
-        filter={
-            "property": "Канал/чат",
-            "rich_text": {
-                "equals": chat_id
-            }
-        }
-    )
-    
-    if not response.get("results"):
-        logger.error(f"Чат {chat_id} не найден в базе")
-        return
-        
-    page = response["results"][0]
-    properties = page.get("properties", {})
-    
-    # Получаем все необходимые метрики
-    metrics = {
+MODEL_PATH = 'final_leadl_chat_quality_model.pkl'
+
+@functools.lru_cache(maxsize=1)
+def load_model(path=MODEL_PATH):
+    """Модель загружается один раз на процесс, а не на каждый чат"""
+    return joblib.load(path)
+
+def page_metrics(properties):
+    """Признаки модели по свойствам страницы Notion"""
+    return {
         "subscribers": properties.get("Подписчиков", {}).get("number", 0),
         "dau": properties.get("DAU", {}).get("number", 0),
         "dau_percent": properties.get("DAU %", {}).get("number", 0),
@@ -43,12 +27,23 @@ def evaluate_chat(chat_id):
         "days_with_msgs": properties.get("Дней с сообщениями (30д)", {}).get("number", 0),
         "msgs_last_24h": properties.get("Всего сообщений (24ч)", {}).get("number", 0)
     }
-    
-    # Проверяем, есть ли хотя бы базовые метрики
-    if metrics["subscribers"] is None or metrics["dau"] is None:
-        logger.error(f"Отсутствуют базовые метрики для чата {chat_id}")
-        return
-    
+
+def analysis_metrics(analysis_results):
+    """Признаки модели по результатам анализа бота — те же, что попадут в Notion"""
+    return {
+        "subscribers": analysis_results.get("members_count", 0),
+        "dau": analysis_results.get("dau", 0),
+        "dau_percent": analysis_results.get("dau_percent", 0),
+        "dau_month_avg_percent": analysis_results.get("monthly_avg_dau_percent", 0),
+        "dau_month_avg": analysis_results.get("monthly_avg_dau", 0),
+        "days_with_msgs": analysis_results.get("days_with_messages", 0),
+        "msgs_last_24h": analysis_results.get("total_messages", 0)
+    }
+
+def predict_quality(metrics):
+    """Предсказание модели: (1 — качественный / 0, вероятность качества)"""
+    model = load_model()
+    metrics = dict(metrics)
     # Если среднее за месяц отсутствует, используем текущее значение
     if metrics["dau_month_avg"] is None:
         metrics["dau_month_avg"] = metrics["dau"]
@@ -58,24 +53,48 @@ def evaluate_chat(chat_id):
     # Создаем DataFrame для предсказания
     df = pd.DataFrame([metrics])
     
+    with MODEL_INFERENCE_SECONDS.time():
+        prediction = model.predict(df)[0]
+        probability = model.predict_proba(df)[0][1]
+    return prediction, probability
+
+def prediction_properties(prediction, probability):
+    """Свойства Notion с результатом оценки"""
+    return {
+        "Prediction": {
+            "select": {
+                "name": "Качественный" if prediction == 1 else "Низкокачественный"
+            }
+        },
+        "Quality Probability": {
+            "number": float(probability)
+        }
+    }
+
+def evaluate_chat(chat_id):
+    """
+    Оценивает качество чата с помощью предобученной модели
+    """
+    # Получаем метрики чата из локальной копии базы Notion
+    notion = NotionIntegration()
+    page = notion.find_chat_page(chat_id)
+    
+    if page is None:
+        logger.error(f"Чат {chat_id} не найден в базе")
+        return
+        
+    metrics = page_metrics(page.get("properties", {}))
+    
+    # Проверяем, есть ли хотя бы базовые метрики
+    if metrics["subscribers"] is None or metrics["dau"] is None:
+        logger.error(f"Отсутствуют базовые метрики для чата {chat_id}")
+        return
+    
     # Делаем предсказание
-    prediction = model.predict(df)[0]
-    probability = model.predict_proba(df)[0][1]
+    prediction, probability = predict_quality(metrics)
     
     # Обновляем результаты в Notion
-    notion.notion.pages.update(
-        page_id=page["id"],
-        properties={
-            "Prediction": {
-                "select": {
-                    "name": "Качественный" if prediction == 1 else "Низкокачественный"
-                }
-            },
-            "Quality Probability": {
-                "number": float(probability)
-            }
-        }
-    )
+    notion.update_page(page["id"], prediction_properties(prediction, probability))
     
     logger.info(f"\nРезультаты оценки для {chat_id}:")
     logger.info(f"Предсказание: {'Качественный' if prediction == 1 else 'Низкокачественный'}")
@@ -0,0 +1,249 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import math
+import random
+import time
+import zlib
+from array import array
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from telethon.errors import ChannelInvalidError, FloodWaitError
+from telethon.tl.types import Channel, PeerUser
+
+from chat_ids import normalize_chat_id
+
+logger = logging.getLogger(__name__)
+
+# Задержка ответа по методам: (мин, макс) в секундах симулированного времени
+DEFAULT_LATENCIES = {
+    'GetFullChannelRequest': (0.2, 0.6),
+    'GetHistoryRequest': (0.1, 0.4),
+    'ResolveUsername': (0.1, 0.3),
+}
+DEFAULT_LATENCY = (0.05, 0.2)
+
+
+class FakeChat:
+    """
+    Синтетический чат: метаданные канала и история сообщений в компактных массивах
+    (id и даты по возрастанию). Активность подчиняется логнормальному распределению
+    объёма сообщений в день, а отправители — закону Ципфа: небольшое ядро пишет
+    большую часть сообщений, как в реальных чатах.
+    """
+
+    def __init__(self, index, rng, now, history_days=35):
+        self.id = 1_000_000 + index
+        self.username = f'bench_chat_{index}'
+        self.title = f'Bench chat {index}'
+        self.megagroup = rng.random() < 0.8
+        self.members_count = int(rng.lognormvariate(math.log(2000), 1.2)) + 10
+        self.about = f'Синтетический чат №{index}'
+        self.date = now - timedelta(days=rng.randint(history_days, 3000))
+        per_day = rng.lognormvariate(math.log(60), 1.5)
+        if not self.megagroup:
+            per_day = min(per_day, 20)  # в каналах пишут только админы
+        count = min(int(per_day * history_days), 200_000)
+        start_ts = int((now - timedelta(days=history_days)).timestamp())
+        span = int(now.timestamp()) - start_ts
+        self.dates = array('q', sorted(start_ts + int(rng.random() * span) for _ in range(count)))
+        self.ids = array('q', range(1, count + 1))
+        self.senders = array('q', self._senders(rng, count))
+
+    def _senders(self, rng, count):
+        if not self.megagroup or not count:
+            return [0] * count
+        audience = max(5, int(self.members_count * rng.uniform(0.02, 0.2)))
+        weights = list(itertools.accumulate(1 / (rank ** 1.1) for rank in range(1, audience + 1)))
+        base = self.id * 100_000
+        return [base + rank for rank in rng.choices(range(audience), cum_weights=weights, k=count)]
+
+    def history(self, limit, offset_id=0, offset_date=None, min_id=0, max_id=0):
+        """Страница истории от новых к старым с семантикой messages.GetHistory"""
+        hi = len(self.ids)
+        if offset_id:
+            hi = bisect.bisect_left(self.ids, offset_id)
+        if max_id:
+            hi = min(hi, bisect.bisect_left(self.ids, max_id))
+        if offset_date is not None:
+            hi = min(hi, bisect.bisect_left(self.dates, int(offset_date.timestamp())))
+        lo = bisect.bisect_right(self.ids, min_id) if min_id else 0
+        start = max(lo, hi - limit)
+        return [self._message(i) for i in range(hi - 1, start - 1, -1)]
+
+    def _message(self, i):
+        sender = self.senders[i]
+        return SimpleNamespace(
+            id=self.ids[i],
+            date=datetime.fromtimestamp(self.dates[i], timezone.utc),
+            from_id=PeerUser(sender) if sender else None,
+        )
+
+
+class FloodPolicy:
+    """
+    Когда отвечать FloodWaitError: случайно с вероятностью `probability` на любой
+    запрос и/или при превышении квоты аккаунта на метод — quotas = {метод: (запросов, за секунд)}.
+    Время ожидания берётся равномерно из `seconds`.
+    """
+
+    def __init__(self, probability=0.0, seconds=(5, 30), quotas=None, seed=None):
+        self.probability = probability
+        self.seconds = seconds
+        self.quotas = quotas or {}
+        self.rng = random.Random(seed)
+        self.calls = {}
+
+    def check(self, account, method, now):
+        """Секунды FloodWait для запроса в момент now (симулированное время) или 0"""
+        quota = self.quotas.get(method)
+        if quota:
+            calls, per = quota
+            window = self.calls.setdefault((account, method), deque())
+            while window and window[0] <= now - per:
+                window.popleft()
+            if len(window) >= calls:
+                return max(window[0] + per - now, 1)
+            window.append(now)
+        if self.probability and self.rng.random() < self.probability:
+            return self.rng.uniform(*self.seconds)
+        return 0
+
+
+class FakeTelegram:
+    """
+    Офлайн-замена Telegram для бенчмарков TelegramAnalyzer: набор синтетических
+    чатов, задержки ответов и FloodWait по политике. Время ускорено в `speedup` раз —
+    задержки и FloodWait делятся на него, а clock() возвращает симулированные секунды.
+    Считает запросы по чатам и методам.
+    """
+
+    def __init__(self, chats=50, seed=0, speedup=1.0, flood_policy=None, latencies=None, history_days=35):
+        self.rng = random.Random(seed)
+        self.speedup = speedup
+        self.flood_policy = flood_policy or FloodPolicy(seed=seed)
+        self.latencies = dict(DEFAULT_LATENCIES)
+        if latencies:
+            self.latencies.update(latencies)
+        now = datetime.now(timezone.utc)
+        self.chats = [FakeChat(i, self.rng, now, history_days) for i in range(chats)]
+        self.by_username = {chat.username: chat for chat in self.chats}
+        self.by_id = {chat.id: chat for chat in self.chats}
+        self.requests = Counter()  # (chat username, метод) -> запросов
+        self.flood_waits = Counter()  # метод -> число FloodWait
+        self.started = time.monotonic()
+
+    def clock(self):
+        return (time.monotonic() - self.started) * self.speedup
+
+    def access_hash(self, chat, account):
+        """access_hash, как и в Telegram, у каждого аккаунта свой"""
+        return (chat.id * 1_000_003 + zlib.crc32(account.encode())) & 0x7FFFFFFFFFFFFFFF
+
+    async def call(self, account, method, chat=None, request=None):
+        """Задержка ответа, учёт запроса и, возможно, FloodWaitError"""
+        low, high = self.latencies.get(method, DEFAULT_LATENCY)
+        await asyncio.sleep(self.rng.uniform(low, high) / self.speedup)
+        self.requests[(chat.username if chat else None, method)] += 1
+        seconds = self.flood_policy.check(account, method, self.clock())
+        if seconds:
+            self.flood_waits[method] += 1
+            error = FloodWaitError(request=request)
+            error.seconds = seconds / self.speedup
+            raise error
+
+    def client_factory(self, idx, account, proxy=None):
+        """Совместима с TelegramAnalyzer(client_factory=...)"""
+        return FakeTelegramClient(self, account['session'])
+
+
+class FakeTelegramClient:
+    """Минимальное подмножество TelegramClient, которое использует TelegramAnalyzer"""
+
+    def __init__(self, backend, account):
+        self.backend = backend
+        self.account = account
+        self.session = SimpleNamespace(filename=f'{account}.session')
+        self.connected = False
+
+    async def connect(self):
+        await asyncio.sleep(self.backend.rng.uniform(0.2, 1.0) / self.backend.speedup)
+        self.connected = True
+
+    async def is_user_authorized(self):
+        return True
+
+    async def start(self):
+        await self.connect()
+        return self
+
+    async def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    def _channel(self, chat, participants=False):
+        """Channel; participants=True — с participants_count, как в ответе GetChannelsRequest"""
+        return Channel(
+            id=chat.id, title=chat.title, photo=None, date=chat.date,
+            access_hash=self.backend.access_hash(chat, self.account),
+            username=chat.username, megagroup=chat.megagroup, broadcast=not chat.megagroup,
+            participants_count=chat.members_count if participants else None,
+        )
+
+    def _chat(self, peer, request=None):
+        """Чат по InputPeerChannel/InputChannel с проверкой access_hash аккаунта"""
+        chat = self.backend.by_id.get(getattr(peer, 'channel_id', None))
+        if chat is None or peer.access_hash != self.backend.access_hash(chat, self.account):
+            raise ChannelInvalidError(request=request)
+        return chat
+
+    async def get_entity(self, chat_id):
+        username = normalize_chat_id(chat_id)
+        chat = self.backend.by_username.get(username)
+        await self.backend.call(self.account, 'ResolveUsername', chat)
+        if chat is None:
+            raise ValueError(f'No user has "{username}" as username')
+        return self._channel(chat)
+
+    async def __call__(self, request):
+        method = type(request).__name__
+        if method == 'GetFullChannelRequest':
+            chat = self._chat(request.channel, request)
+            await self.backend.call(self.account, method, chat, request)
+            return SimpleNamespace(
+                full_chat=SimpleNamespace(id=chat.id, about=chat.about, participants_count=chat.members_count),
+                chats=[self._channel(chat)], users=[],
+            )
+        if method == 'GetChannelsRequest':
+            chats = [self._chat(channel, request) for channel in request.id]
+            await self.backend.call(self.account, method, chats[0] if len(chats) == 1 else None, request)
+            return SimpleNamespace(chats=[self._channel(chat, participants=True) for chat in chats])
+        if method == 'GetHistoryRequest':
+            chat = self._chat(request.peer, request)
+            await self.backend.call(self.account, method, chat, request)
+            return SimpleNamespace(messages=chat.history(
+                request.limit, offset_id=request.offset_id, offset_date=request.offset_date,
+                min_id=request.min_id, max_id=request.max_id,
+            ))
+        raise NotImplementedError(f'fake_telegram: {method} не поддерживается')
+
+    async def iter_messages(self, peer, limit=None, min_id=0):
+        """Как TelegramClient.iter_messages: страницы по 100 сообщений, каждая — GetHistoryRequest"""
+        chat = self._chat(peer)
+        remaining = limit if limit is not None else float('inf')
+        offset_id = 0
+        while remaining > 0:
+            page_size = int(min(100, remaining))
+            await self.backend.call(self.account, 'GetHistoryRequest', chat)
+            page = chat.history(page_size, offset_id=offset_id, min_id=min_id)
+            for message in page:
+                yield message
+            remaining -= len(page)
+            if len(page) < page_size:
+                return
+            offset_id = page[-1].id
@@ -99,17 +99,12 @@ def analyze_analyzed_chats():
         notion = NotionIntegration()
         
         # Получаем данные из Notion
-        response = notion.notion.databases.query(
-            database_id=notion.database_id,
-            filter={
-                "property": "Status",
-                "select": {
-                    "equals": "Analyzed"
-                }
+        results = list(notion.iter_pages(filter={
+            "property": "Status",
+            "select": {
+                "equals": "Analyzed"
             }
-        )
-        
-        results = response.get("results", [])
+        }))
         logger.info(f"Найдено {len(results)} чатов со статусом 'Analyzed'")
         
         # Подготавливаем данные для анализа
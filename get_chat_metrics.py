@@ -19,24 +19,12 @@ def get_chat_metrics(chat_id: str) -> dict:
     try:
         notion = NotionIntegration()
         
-        # Ищем чат в базе данных
-        response = notion.notion.databases.query(
-            database_id=notion.database_id,
-            filter={
-                "property": "Канал/чат",
-                "rich_text": {
-                    "contains": chat_id
-                }
-            }
-        )
-        
-        results = response.get("results", [])
-        if not results:
+        # Ищем чат в локальной копии базы
+        page = notion.find_chat_page(chat_id)
+        if page is None:
             logger.error(f"Чат {chat_id} не найден в базе данных")
             return None
             
-        # Берем первый найденный результат
-        page = results[0]
         properties = page.get("properties", {})
         
         # Извлекаем метрики
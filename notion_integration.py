@@ -4,6 +4,10 @@ from notion_client import Client
 from dotenv import load_dotenv
 import pandas as pd
 import logging
+from metrics import NOTION_PAGE_UPDATES, NOTION_REQUEST_SECONDS
+from notion_mirror import changed_properties, get_mirror
+from notion_pager import iter_query
+from report_sink import ReportSink
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,96 +34,154 @@ def safe_get_title(properties):
         return title[0]["text"].get("content", "")
     return ""
 
+class InstrumentedClient(Client):
+    """Клиент Notion, замеряющий длительность каждого запроса к API"""
+
+    def request(self, path, method, query=None, body=None, auth=None):
+        # databases/<id>/query -> POST databases.query, pages/<id> -> PATCH pages
+        parts = path.strip('/').split('/')
+        endpoint = parts[0] + (f'.{parts[-1]}' if len(parts) > 2 else '')
+        with NOTION_REQUEST_SECONDS.time(endpoint=f'{method} {endpoint}'):
+            return super().request(path, method, query=query, body=body, auth=auth)
+
 class NotionIntegration:
     def __init__(self):
-        self.notion = Client(auth=os.getenv("NOTION_TOKEN"))
+        self.notion = InstrumentedClient(auth=os.getenv("NOTION_TOKEN"))
         self.database_id = os.getenv("NOTION_DATABASE_ID")
 
+    @property
+    def mirror(self):
+        """Локальная копия базы (notion_mirror), общая для всех экземпляров в процессе"""
+        return get_mirror(self.notion, self.database_id)
+
+    def find_chat_page(self, chat_id):
+        """
+        Страница чата по «Канал/чат» в любом формате ссылки или None.
+        Ищется в локальной копии базы, а не отдельным запросом к Notion.
+        """
+        return self.mirror.find(chat_id)
+
+    def snapshot_pages(self, full=False):
+        """
+        Все страницы базы из локальной копии после инкрементальной синхронизации:
+        из Notion запрашиваются только страницы, изменённые с прошлого запуска.
+        full=True — полная перезагрузка базы.
+        """
+        return self.mirror.snapshot(full=full)
+
+    def update_page(self, page_id, properties):
+        """
+        pages.update только с изменившимися свойствами: сравнение идёт с последним
+        известным состоянием страницы в локальной копии базы. Если не изменилось
+        ничего, запрос не отправляется. Ответ API обновляет страницу в копии.
+        """
+        mirror = self.mirror
+        mirror.ensure_fresh()
+        current = mirror.get_page(page_id)
+        if current is not None:
+            properties = changed_properties(current, properties)
+            if not properties:
+                NOTION_PAGE_UPDATES.inc(result='skipped')
+                logger.info(f"Страница {page_id} не изменилась, запись в Notion пропущена")
+                return current
+        page = self.notion.pages.update(page_id=page_id, properties=properties)
+        NOTION_PAGE_UPDATES.inc(result='sent')
+        mirror.upsert(page)
+        return page
+
+    def iter_pages(self, filter=None, sorts=None, **kwargs):
+        """
+        Страницы базы по одной со всеми страницами выдачи (notion_pager):
+        следующая страница выдачи запрашивается, пока обрабатывается текущая.
+        """
+        return iter_query(self.notion, self.database_id, filter=filter, sorts=sorts, **kwargs)
+
     def get_chats_to_analyze(self) -> List[Dict[str, Any]]:
         """
         Получает список чатов для анализа из Notion базы данных
         """
-        response = self.notion.databases.query(
-            database_id=self.database_id,
-            filter={
-                "property": "Status",
-                "select": {
-                    "equals": "To Analyze"
-                }
+        return list(self.iter_pages(filter={
+            "property": "Status",
+            "select": {
+                "equals": "To Analyze"
             }
-        )
-        return response.get("results", [])
+        }))
 
     def update_chat_analysis(self, page_id: str, analysis_results: Dict[str, Any], status: str = "Analyzed"):
         """
         Обновляет страницу в Notion с результатами анализа и статусом
         """
-        self.notion.pages.update(
-            page_id=page_id,
-            properties={
-                "Status": {"select": {"name": status}},
-                "Канал/чат": {"rich_text": [{"text": {"content": analysis_results.get("chat_id", "")}}]},
-                "Название": {"title": [{"text": {"content": analysis_results.get("name", "")}}]},
-                "Описание": {"rich_text": [{"text": {"content": analysis_results.get("description", "")}}]},
-                "Подписчиков": {"number": analysis_results.get("members_count", 0)},
-                "DAU": {"number": analysis_results.get("dau", 0)},
-                "DAU %": {"number": analysis_results.get("dau_percent", 0)},
-                "DAU (месяц, среднее)": {"number": analysis_results.get("monthly_avg_dau", 0)},
-                "DAU % (месяц, среднее)": {"number": analysis_results.get("monthly_avg_dau_percent", 0)},
-                "Дней с сообщениями (30д)": {"number": analysis_results.get("days_with_messages", 0)},
-                "Всего сообщений (24ч)": {"number": analysis_results.get("total_messages", 0)},
-                "Резюме": {"rich_text": [{"text": {"content": analysis_results.get("resume", "")}}]},
-                "Аккаунт": {"rich_text": [{"text": {"content": analysis_results.get("account", "")}}]},
-                "Activity Score": {"number": analysis_results.get("activity_score", 0)},
-                "Last Analysis": {"date": {"start": pd.Timestamp.now().isoformat()}},
-                "Analysis Notes": {"rich_text": [{"text": {"content": analysis_results.get("notes", "")}}]}
-            }
-        )
+        self.update_page(page_id, self.analysis_properties(analysis_results, status))
+
+    @staticmethod
+    def analysis_properties(analysis_results: Dict[str, Any], status: str = "Analyzed") -> Dict[str, Any]:
+        """Свойства страницы Notion по результатам анализа чата"""
+        return {
+            "Status": {"select": {"name": status}},
+            "Канал/чат": {"rich_text": [{"text": {"content": analysis_results.get("chat_id", "")}}]},
+            "Название": {"title": [{"text": {"content": analysis_results.get("name", "")}}]},
+            "Описание": {"rich_text": [{"text": {"content": analysis_results.get("description", "")}}]},
+            "Подписчиков": {"number": analysis_results.get("members_count", 0)},
+            "DAU": {"number": analysis_results.get("dau", 0)},
+            "DAU %": {"number": analysis_results.get("dau_percent", 0)},
+            "DAU (месяц, среднее)": {"number": analysis_results.get("monthly_avg_dau", 0)},
+            "DAU % (месяц, среднее)": {"number": analysis_results.get("monthly_avg_dau_percent", 0)},
+            "Дней с сообщениями (30д)": {"number": analysis_results.get("days_with_messages", 0)},
+            "Всего сообщений (24ч)": {"number": analysis_results.get("total_messages", 0)},
+            "Резюме": {"rich_text": [{"text": {"content": analysis_results.get("resume", "")}}]},
+            "Аккаунт": {"rich_text": [{"text": {"content": analysis_results.get("account", "")}}]},
+            "Activity Score": {"number": analysis_results.get("activity_score", 0)},
+            "Last Analysis": {"date": {"start": pd.Timestamp.now().isoformat()}},
+            "Analysis Notes": {"rich_text": [{"text": {"content": analysis_results.get("notes", "")}}]}
+        }
 
-    def export_to_excel(self, filename):
-        """Экспорт данных из Notion в Excel"""
+    def export_to_excel(self, filename, pages=None):
+        """
+        Экспорт данных из Notion в файл (xlsx, csv или parquet — по расширению).
+        Страницы базы читаются с пагинацией и сразу пишутся в отчёт,
+        так что в памяти одновременно не больше двух страниц выдачи Notion.
+        pages — уже полученные страницы (например, snapshot_pages()) вместо запроса к базе.
+        """
         try:
-            # Получаем все страницы из базы данных
-            pages = self.notion.databases.query(database_id=self.database_id).get("results", [])
-            if not pages:
+            with ReportSink(filename) as sink:
+                if pages is None:
+                    pages = self.iter_pages()
+                sink.write_many(self._export_row(page) for page in pages)
+            if not sink.rows:
                 logger.warning("Нет данных для экспорта")
                 return
-
-            # Подготавливаем данные для Excel
-            data = []
-            for page in pages:
-                properties = page.get("properties", {})
-                # Безопасное извлечение значений с проверкой на None
-                last_analysis = properties.get("Last Analysis", {})
-                last_analysis_date = last_analysis.get("date", {}) if last_analysis else {}
-                last_analysis_start = last_analysis_date.get("start", "") if last_analysis_date else ""
-
-                data.append({
-                    "ID": page.get("id", ""),
-                    "Name": properties.get("Name", {}).get("title", [{}])[0].get("text", {}).get("content", "") if properties.get("Name", {}).get("title") else "",
-                    "Status": properties.get("Status", {}).get("select", {}).get("name", ""),
-                    "Last Analysis": last_analysis_start,
-                    "Members Count": properties.get("Members Count", {}).get("number", 0),
-                    "DAU": properties.get("DAU", {}).get("number", 0),
-                    "DAU %": properties.get("DAU %", {}).get("number", 0),
-                    "Monthly Avg DAU": properties.get("Monthly Avg DAU", {}).get("number", 0),
-                    "Monthly Avg DAU %": properties.get("Monthly Avg DAU %", {}).get("number", 0),
-                    "Days With Messages": properties.get("Days With Messages", {}).get("number", 0),
-                    "Total Messages": properties.get("Total Messages", {}).get("number", 0),
-                    "Resume": properties.get("Resume", {}).get("rich_text", [{}])[0].get("text", {}).get("content", "") if properties.get("Resume", {}).get("rich_text") else "",
-                    "Cache Date": properties.get("Cache Date", {}).get("date", {}).get("start", "") if properties.get("Cache Date", {}).get("date") else "",
-                    "Account": properties.get("Account", {}).get("rich_text", [{}])[0].get("text", {}).get("content", "") if properties.get("Account", {}).get("rich_text") else "",
-                    "Activity Score": properties.get("Activity Score", {}).get("number", 0),
-                    "Notes": properties.get("Notes", {}).get("rich_text", [{}])[0].get("text", {}).get("content", "") if properties.get("Notes", {}).get("rich_text") else ""
-                })
-
-            # Создаем DataFrame и сохраняем в Excel
-            df = pd.DataFrame(data)
-            df.to_excel(filename, index=False)
-            logger.info(f"Данные успешно экспортированы в {filename}")
+            logger.info(f"Данные успешно экспортированы в {filename} ({sink.rows} строк)")
         except Exception as e:
             logger.error(f"Ошибка при экспорте данных: {e}")
 
+    @staticmethod
+    def _export_row(page):
+        """Строка экспорта по странице базы"""
+        properties = page.get("properties", {})
+        # Безопасное извлечение значений с проверкой на None
+        last_analysis = properties.get("Last Analysis", {})
+        last_analysis_date = last_analysis.get("date", {}) if last_analysis else {}
+        last_analysis_start = last_analysis_date.get("start", "") if last_analysis_date else ""
+
+        return {
+            "ID": page.get("id", ""),
+            "Name": properties.get("Name", {}).get("title", [{}])[0].get("text", {}).get("content", "") if properties.get("Name", {}).get("title") else "",
+            "Status": properties.get("Status", {}).get("select", {}).get("name", ""),
+            "Last Analysis": last_analysis_start,
+            "Members Count": properties.get("Members Count", {}).get("number", 0),
+            "DAU": properties.get("DAU", {}).get("number", 0),
+            "DAU %": properties.get("DAU %", {}).get("number", 0),
+            "Monthly Avg DAU": properties.get("Monthly Avg DAU", {}).get("number", 0),
+            "Monthly Avg DAU %": properties.get("Monthly Avg DAU %", {}).get("number", 0),
+            "Days With Messages": properties.get("Days With Messages", {}).get("number", 0),
+            "Total Messages": properties.get("Total Messages", {}).get("number", 0),
+            "Resume": properties.get("Resume", {}).get("rich_text", [{}])[0].get("text", {}).get("content", "") if properties.get("Resume", {}).get("rich_text") else "",
+            "Cache Date": properties.get("Cache Date", {}).get("date", {}).get("start", "") if properties.get("Cache Date", {}).get("date") else "",
+            "Account": properties.get("Account", {}).get("rich_text", [{}])[0].get("text", {}).get("content", "") if properties.get("Account", {}).get("rich_text") else "",
+            "Activity Score": properties.get("Activity Score", {}).get("number", 0),
+            "Notes": properties.get("Notes", {}).get("rich_text", [{}])[0].get("text", {}).get("content", "") if properties.get("Notes", {}).get("rich_text") else ""
+        }
+
     def get_chat_metrics(self, chat_id):
         """
         Получает метрики чата по chat_id из базы данных Notion.
@@ -129,103 +191,41 @@ class NotionIntegration:
         - @chat_id
         - chat_id
         """
-        # Нормализуем chat_id
-        if chat_id.startswith('https://t.me/'):
-            chat_id = chat_id[13:]
-        elif chat_id.startswith('t.me/'):
-            chat_id = chat_id[5:]
-        elif chat_id.startswith('@'):
-            chat_id = chat_id[1:]
-            
-        # Формируем варианты поиска
-        search_variants = [
-            chat_id,
-            f"https://t.me/{chat_id}",
-            f"t.me/{chat_id}",
-            f"@{chat_id}"
-        ]
-        
-        # Пробуем найти чат по каждому варианту
-        for variant in search_variants:
-            query = {
-                "database_id": self.database_id,
-                "filter": {
-                    "property": "Канал/чат",
-                    "rich_text": {"equals": variant}
-                }
-            }
-            response = self.notion.databases.query(**query)
-            results = response.get("results", [])
-            if results:
-                page = results[0]
-                props = page["properties"]
-                return {
-                    "page_id": page["id"],
-                    "members_count": props.get("Подписчиков", {}).get("number", 0),
-                    "dau": props.get("DAU", {}).get("number", 0),
-                    "dau_percent": props.get("DAU %", {}).get("number", 0),
-                    "dau_month_avg_percent": props.get("DAU % (месяц, среднее)", {}).get("number", 0),
-                    "dau_month_avg": props.get("DAU (месяц, среднее)", {}).get("number", 0),
-                    "active_days": props.get("Дней с сообщениями (30д)", {}).get("number", 0),
-                    "messages_per_day": props.get("Всего сообщений (24ч)", {}).get("number", 0),
-                }
-        
-        return None
+        page = self.find_chat_page(chat_id)
+        if page is None:
+            return None
+        props = page["properties"]
+        return {
+            "page_id": page["id"],
+            "members_count": props.get("Подписчиков", {}).get("number", 0),
+            "dau": props.get("DAU", {}).get("number", 0),
+            "dau_percent": props.get("DAU %", {}).get("number", 0),
+            "dau_month_avg_percent": props.get("DAU % (месяц, среднее)", {}).get("number", 0),
+            "dau_month_avg": props.get("DAU (месяц, среднее)", {}).get("number", 0),
+            "active_days": props.get("Дней с сообщениями (30д)", {}).get("number", 0),
+            "messages_per_day": props.get("Всего сообщений (24ч)", {}).get("number", 0),
+        }
 
     def get_all_chats_with_pagination(self):
         """
         Получает все чаты из базы Notion с поддержкой пагинации
         """
-        all_results = []
-        next_cursor = None
-        while True:
-            kwargs = {"database_id": self.database_id}
-            if next_cursor:
-                kwargs["start_cursor"] = next_cursor
-            response = self.notion.databases.query(**kwargs)
-            all_results.extend(response.get("results", []))
-            if response.get("has_more"):
-                next_cursor = response.get("next_cursor")
-            else:
-                break
-        return all_results
+        return list(self.iter_pages())
 
     def get_chats_to_analyze_with_pagination(self) -> list:
         """
         Получает все чаты со статусом 'To Analyze' с поддержкой пагинации
         """
-        all_results = []
-        next_cursor = None
-        while True:
-            kwargs = {
-                "database_id": self.database_id,
-                "filter": {
-                    "property": "Status",
-                    "select": {"equals": "To Analyze"}
-                }
-            }
-            if next_cursor:
-                kwargs["start_cursor"] = next_cursor
-            response = self.notion.databases.query(**kwargs)
-            all_results.extend(response.get("results", []))
-            if response.get("has_more"):
-                next_cursor = response.get("next_cursor")
-            else:
-                break
-        return all_results
+        return self.get_chats_to_analyze()
 
 def get_analyzed_chats():
     notion = NotionIntegration()
-    response = notion.notion.databases.query(
-        database_id=notion.database_id,
-        filter={
-            "property": "Status",
-            "select": {
-                "equals": "Analyzed"
-            }
+    results = list(notion.iter_pages(filter={
+        "property": "Status",
+        "select": {
+            "equals": "Analyzed"
         }
-    )
-    results = response.get("results", [])
+    }))
     print(f"Найдено {len(results)} чатов со статусом 'Analyzed':")
     for page in results:
         properties = page.get("properties", {})
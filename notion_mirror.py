@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from chat_ids import normalize_chat_id
+from notion_pager import iter_query
+
+logger = logging.getLogger(__name__)
+
+# Свойство базы, по которому ищутся чаты
+CHAT_PROPERTY = "Канал/чат"
+# Зеркало старше этого (секунды) синхронизируется перед поиском
+MIRROR_TTL = float(os.getenv('NOTION_MIRROR_TTL', '300'))
+# Как часто (секунды) сверять список страниц, чтобы найти удалённые
+SWEEP_INTERVAL = float(os.getenv('NOTION_MIRROR_SWEEP', '3600'))
+# Свойство, которое запрашивается при сверке: у заголовка базы id всегда 'title'
+SWEEP_PROPERTIES = ["title"]
+MIRROR_DB = os.getenv('NOTION_MIRROR_DB', 'notion_mirror.db')
+# Свойства, которые меняются при каждой записи (время анализа): сами по себе
+# не повод писать страницу, но отправляются вместе с другими изменениями
+VOLATILE_PROPERTIES = ("Last Analysis",)
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def page_chat_key(page):
+    """Нормализованный id чата страницы (по свойству «Канал/чат»)"""
+    rich = page.get("properties", {}).get(CHAT_PROPERTY, {}).get("rich_text") or []
+    text = ''.join(part.get("plain_text") or part.get("text", {}).get("content", "") for part in rich)
+    return normalize_chat_id(text)
+
+
+def property_value(prop):
+    """
+    Значение свойства в сравнимом виде: одинаковое для свойства из запроса
+    pages.update ({"number": 5}) и из ответа API ({"id": ..., "type": "number", "number": 5})
+    """
+    if not isinstance(prop, dict):
+        return prop
+    for kind in ("title", "rich_text"):
+        if kind in prop:
+            return ''.join(
+                (part.get("text") or {}).get("content") or part.get("plain_text", "") for part in prop[kind] or []
+            )
+    if "number" in prop:
+        return prop["number"]
+    for kind in ("select", "status"):
+        if kind in prop:
+            return (prop[kind] or {}).get("name")
+    if "date" in prop:
+        return (prop["date"] or {}).get("start")
+    return {key: value for key, value in prop.items() if key not in ("id", "type")}
+
+
+def changed_properties(page, properties, volatile=VOLATILE_PROPERTIES):
+    """
+    Свойства из properties, значения которых отличаются от страницы page.
+    Если отличаются только volatile-свойства, изменений нет — возвращается {}.
+    """
+    current = page.get("properties", {})
+    changed = {
+        name: prop for name, prop in properties.items()
+        if name not in current or property_value(current[name]) != property_value(prop)
+    }
+    if all(name in volatile for name in changed):
+        return {}
+    return changed
+
+
+class NotionMirror:
+    """
+    Локальная копия базы Notion в SQLite: страница целиком (как её отдаёт API)
+    и индекс по нормализованному id чата. Поиск чата — запрос к SQLite вместо
+    фильтрованного databases.query. Страницы, которые мы сами записали,
+    обновляются в копии сразу по ответу pages.update.
+
+    Синхронизация инкрементальная: запоминается максимальный last_edited_time
+    (водяной знак), и из Notion запрашиваются только страницы, изменённые с тех пор.
+    Удалённые и архивные страницы в такой выборке не видны, поэтому раз в
+    sweep_interval список id сверяется с Notion запросом, который возвращает
+    страницы без свойств (только заголовок).
+    """
+
+    def __init__(self, notion, database_id, db_path=MIRROR_DB, ttl=MIRROR_TTL, sweep_interval=SWEEP_INTERVAL):
+        self.notion = notion
+        self.database_id = database_id
+        self.db_path = db_path
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "page_id TEXT PRIMARY KEY, database_id TEXT NOT NULL, chat_key TEXT NOT NULL, "
+            "last_edited_time TEXT, data TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_chat_key ON pages (database_id, chat_key)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state ("
+            "database_id TEXT PRIMARY KEY, synced_at REAL NOT NULL, last_edited TEXT, swept_at REAL)"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(sync_state)")}
+        for column, kind in (('last_edited', 'TEXT'), ('swept_at', 'REAL')):
+            if column not in columns:
+                # Копия, созданная до инкрементальной синхронизации
+                self.conn.execute(f"ALTER TABLE sync_state ADD COLUMN {column} {kind}")
+        self.conn.commit()
+
+    def _state(self):
+        """(synced_at, водяной знак last_edited_time, время последней сверки) или None"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT synced_at, last_edited, swept_at FROM sync_state WHERE database_id = ?", (self.database_id,)
+            ).fetchone()
+
+    def synced_at(self):
+        state = self._state()
+        return state[0] if state else None
+
+    def is_fresh(self):
+        synced_at = self.synced_at()
+        return synced_at is not None and time.time() - synced_at < self.ttl
+
+    def _query_all(self, **kwargs):
+        """Все страницы выборки databases.query, постранично"""
+        return iter_query(self.notion, self.database_id, **kwargs)
+
+    def sync(self, full=False):
+        """
+        Синхронизирует копию с Notion: инкрементально по водяному знаку
+        last_edited_time, полностью — при full=True или для пустой копии.
+        Возвращает число полученных страниц.
+        """
+        state = self._state()
+        if full or not state or not state[1]:
+            return self._full_sync()
+        started = time.time()
+        _, watermark, swept_at = state
+        count = 0
+        # last_edited_time в Notion округляется до минуты, поэтому on_or_after:
+        # страницы с той же минутой, что и водяной знак, приходят повторно, но не теряются
+        edited = self._query_all(filter={
+            "timestamp": "last_edited_time",
+            "last_edited_time": {"on_or_after": watermark},
+        })
+        for page in edited:
+            self.upsert(page)
+            watermark = max(watermark, page.get("last_edited_time") or watermark)
+            count += 1
+        removed = None
+        if swept_at is None or started - swept_at >= self.sweep_interval:
+            removed = self.sweep()
+            swept_at = started
+        with self.lock, self.conn:
+            self._set_state(started, watermark, swept_at)
+        logger.info(
+            f"Зеркало Notion: изменено {count} страниц"
+            + (f", удалено {removed}" if removed is not None else "")
+            + f" за {time.time() - started:.1f} с"
+        )
+        return count
+
+    def _full_sync(self):
+        """Полная синхронизация: все страницы базы, удалённые из базы — удаляются и из копии"""
+        started = time.time()
+        pages = list(self._query_all())
+        watermark = max((page.get("last_edited_time") or "" for page in pages), default="") or None
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM pages WHERE database_id = ?", (self.database_id,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pages (page_id, database_id, chat_key, last_edited_time, data) VALUES (?, ?, ?, ?, ?)",
+                (self._row(page) for page in pages)
+            )
+            self._set_state(started, watermark, started)
+        logger.info(f"Зеркало Notion синхронизировано полностью: {len(pages)} страниц за {time.time() - started:.1f} с")
+        return len(pages)
+
+    def sweep(self):
+        """
+        Удаляет из копии страницы, которых больше нет в базе. Список id
+        запрашивается без свойств страниц, так что ответы в разы меньше полных.
+        """
+        alive = {page["id"] for page in self._query_all(filter_properties=SWEEP_PROPERTIES)}
+        with self.lock, self.conn:
+            known = [row[0] for row in self.conn.execute(
+                "SELECT page_id FROM pages WHERE database_id = ?", (self.database_id,)
+            )]
+            removed = [(page_id,) for page_id in known if page_id not in alive]
+            self.conn.executemany("DELETE FROM pages WHERE page_id = ?", removed)
+        return len(removed)
+
+    def ensure_fresh(self):
+        if self.is_fresh():
+            return
+        with self.sync_lock:
+            # Пока ждали блокировку, копию мог обновить другой поток
+            if not self.is_fresh():
+                self.sync()
+
+    def snapshot(self, full=False):
+        """Синхронизирует копию (по умолчанию инкрементально) и возвращает все её страницы"""
+        with self.sync_lock:
+            self.sync(full=full)
+        return self.pages()
+
+    def pages(self, batch_size=500):
+        """
+        Все страницы копии по порядку page_id. Читаются пачками, и блокировка
+        между пачками отпускается: обработка страниц может обращаться к копии.
+        """
+        last_id = ''
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT page_id, data FROM pages WHERE database_id = ? AND page_id > ? "
+                    "ORDER BY page_id LIMIT ?",
+                    (self.database_id, last_id, batch_size)
+                ).fetchall()
+            for _, data in rows:
+                yield json.loads(data)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def find(self, chat_id):
+        """
+        Страница чата в любом формате ссылки (https://t.me/x, t.me/x, @x, x) или None.
+        Если в копии чата нет (страницу могли добавить после синхронизации),
+        делается один запрос contains к Notion, найденное попадает в копию.
+        """
+        key = normalize_chat_id(chat_id)
+        if not key:
+            return None
+        self.ensure_fresh()
+        page = self._lookup(key)
+        if page is None:
+            for result in self._query_all(filter={"property": CHAT_PROPERTY, "rich_text": {"contains": key}}):
+                if page_chat_key(result) == key:
+                    self.upsert(result)
+            page = self._lookup(key)
+        return page
+
+    def get_page(self, page_id):
+        """Последнее известное состояние страницы или None"""
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM pages WHERE page_id = ?", (page_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _lookup(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM pages WHERE database_id = ? AND chat_key = ? "
+                "ORDER BY last_edited_time DESC LIMIT 1",
+                (self.database_id, key)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def upsert(self, page):
+        """Кладёт в копию страницу из ответа API (например, результат pages.update)"""
+        if not page or page.get("object") != "page":
+            return
+        if page.get("archived") or page.get("in_trash"):
+            self.remove(page["id"])
+            return
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (page_id, database_id, chat_key, last_edited_time, data) VALUES (?, ?, ?, ?, ?)",
+                self._row(page)
+            )
+
+    def remove(self, page_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM pages WHERE page_id = ?", (page_id,))
+
+    def _row(self, page):
+        return (page["id"], self.database_id, page_chat_key(page), page.get("last_edited_time"),
+                json.dumps(page, ensure_ascii=False))
+
+    def _set_state(self, synced_at, last_edited, swept_at):
+        self.conn.execute(
+            "INSERT INTO sync_state (database_id, synced_at, last_edited, swept_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(database_id) DO UPDATE SET synced_at = excluded.synced_at, "
+            "last_edited = excluded.last_edited, swept_at = excluded.swept_at",
+            (self.database_id, synced_at, last_edited, swept_at)
+        )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def get_mirror(notion, database_id):
+    """Общая на процесс копия базы: скрипты создают NotionIntegration на каждый чат"""
+    with _mirrors_lock:
+        mirror = _mirrors.get(database_id)
+        if mirror is None:
+            mirror = _mirrors[database_id] = NotionMirror(notion, database_id)
+        return mirror
@@ -0,0 +1,35 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер страницы выдачи databases.query
+PAGE_SIZE = 100
+
+
+def iter_query(client, database_id, filter=None, sorts=None, page_size=PAGE_SIZE, **kwargs):
+    """
+    Все страницы выборки databases.query по одной, с пагинацией по курсору.
+    Запрос следующей страницы выдачи уходит в фоновом потоке, как только известен
+    курсор, — пока вызывающий код обрабатывает текущую. Остальные kwargs
+    передаются в databases.query как есть (например, filter_properties).
+    """
+    query = {"database_id": database_id, "page_size": page_size, **kwargs}
+    if filter:
+        query["filter"] = filter
+    if sorts:
+        query["sorts"] = sorts
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='notion-prefetch')
+    future = executor.submit(client.databases.query, **query)
+    try:
+        while future is not None:
+            response = future.result()
+            future = None
+            if response.get("has_more") and response.get("next_cursor"):
+                future = executor.submit(client.databases.query, **query, start_cursor=response["next_cursor"])
+            yield from response.get("results", [])
+    finally:
+        # Генератор могли бросить на середине — лишнюю страницу не ждём
+        if future is not None:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,90 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Сколько страниц может ждать записи; submit блокируется, пока очередь полна
+DEFAULT_QUEUE_SIZE = 50
+
+
+class NotionWriter:
+    """
+    Отложенная запись в Notion: полный набор свойств страницы ставится в
+    ограниченную очередь и уходит одним pages.update из фонового потока.
+    Если страница ещё ждёт в очереди, новые свойства сливаются с уже
+    поставленными — по-прежнему один запрос. close() дописывает всё, что
+    осталось в очереди, и только потом возвращается.
+
+    on_done(error) вызывается из потока записи после запроса: error — None
+    или исключение, с которым запись не удалась.
+    """
+
+    def __init__(self, notion, maxsize=DEFAULT_QUEUE_SIZE):
+        self.notion = notion
+        self.queue = queue.Queue(maxsize)
+        self.pending = {}  # page_id -> [свойства, колбэки]
+        self.lock = threading.Lock()
+        self.closed = False
+        self.written = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, name='notion-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, page_id, properties, on_done=None):
+        """Ставит свойства страницы в очередь записи"""
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("NotionWriter уже закрыт")
+            entry = self.pending.get(page_id)
+            if entry is not None:
+                entry[0].update(properties)
+                if on_done:
+                    entry[1].append(on_done)
+                return
+            self.pending[page_id] = [dict(properties), [on_done] if on_done else []]
+        self.queue.put(page_id)
+
+    def _run(self):
+        while True:
+            page_id = self.queue.get()
+            try:
+                if page_id is not None:
+                    self._write(page_id)
+            finally:
+                self.queue.task_done()
+            with self.lock:
+                # Страница, поставленная одновременно с close(), всё равно будет записана
+                if self.closed and not self.pending:
+                    return
+
+    def _write(self, page_id):
+        with self.lock:
+            properties, callbacks = self.pending.pop(page_id)
+        error = None
+        try:
+            self.notion.update_page(page_id, properties)
+            self.written += 1
+        except Exception as e:
+            error = e
+            self.failed += 1
+            logger.error(f"Ошибка записи страницы {page_id} в Notion: {e}")
+        for callback in callbacks:
+            try:
+                callback(error)
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике записи страницы {page_id}: {e}")
+
+    def flush(self):
+        """Ждёт, пока будет записано всё, что уже стоит в очереди"""
+        self.queue.join()
+
+    def close(self):
+        """Дописывает очередь и останавливает поток записи"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        logger.info(f"Запись в Notion завершена: записано {self.written} страниц, ошибок {self.failed}")
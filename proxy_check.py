@@ -0,0 +1,181 @@
+"""
+Проверка ProxyPool.probe и фоновых проверок прокси без сети: локальная
+заглушка SOCKS5 на asyncio отвечает на приветствие как настоящий прокси,
+отвергает его или обрывает соединение.
+
+    python proxy_check.py
+
+Код возврата 0, если все проверки прошли.
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+from proxy_pool import QUARANTINE_BASE, ProxyPool
+
+logger = logging.getLogger(__name__)
+
+
+class Socks5Stub:
+    """
+    Заглушка SOCKS5-сервера: читает приветствие клиента и отвечает в режиме mode:
+    'ok' — выбирает метод (без аутентификации или логин-пароль), 'reject' — 0xFF
+    (нет подходящих методов), 'close' — закрывает соединение, ничего не ответив.
+    Полученные приветствия сохраняются в greetings.
+    """
+
+    def __init__(self, mode='ok'):
+        self.mode = mode
+        self.greetings = []
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def _handle(self, reader, writer):
+        try:
+            header = await reader.readexactly(2)
+            methods = await reader.readexactly(header[1])
+            self.greetings.append(header + methods)
+            if self.mode == 'ok':
+                writer.write(b'\x05' + (b'\x02' if 2 in methods else b'\x00'))
+            elif self.mode == 'reject':
+                writer.write(b'\x05\xff')
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def proxy(self, auth=False):
+        """Запись прокси в формате proxies.PROXIES"""
+        if auth:
+            return ('socks5', '127.0.0.1', self.port, True, 'user', 'password')
+        return ('socks5', '127.0.0.1', self.port)
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def quarantine_left(pool, proxy):
+    """Сколько секунд прокси ещё в карантине (округлённо)"""
+    return round(pool.stats[proxy].quarantined_until - time.time())
+
+
+async def check_greeting(results):
+    stub = await Socks5Stub('ok').start()
+    try:
+        plain, auth = stub.proxy(), stub.proxy(auth=True)
+        pool = ProxyPool([plain, auth])
+        latency = await pool.probe(plain, timeout=2)
+        results.append(('приветствие без аутентификации', latency is not None and stub.greetings[-1] == b'\x05\x01\x00',
+                        f'задержка {latency}, приветствие {stub.greetings[-1:]!r}'))
+        latency = await pool.probe(auth, timeout=2)
+        results.append(('приветствие с логином и паролем', latency is not None and stub.greetings[-1] == b'\x05\x02\x00\x02',
+                        f'задержка {latency}, приветствие {stub.greetings[-1:]!r}'))
+        s = pool.stats[plain]
+        results.append(('успех учтён в статистике', s.successes == 1 and s.latency is not None and not s.quarantined_until,
+                        f'успехов {s.successes}, задержка {s.latency}'))
+    finally:
+        await stub.close()
+
+
+async def check_failures(results):
+    for mode, name in (('reject', 'отказ 0xFF'), ('close', 'обрыв соединения')):
+        stub = await Socks5Stub(mode).start()
+        try:
+            proxy = stub.proxy()
+            pool = ProxyPool([proxy])
+            latency = await pool.probe(proxy, timeout=2)
+            left = quarantine_left(pool, proxy)
+            results.append((f'{name}: прокси в карантине', latency is None and left == QUARANTINE_BASE,
+                            f'результат {latency}, карантин {left} с'))
+        finally:
+            await stub.close()
+    # Порт, на котором никто не слушает
+    stub = await Socks5Stub().start()
+    proxy = stub.proxy()
+    await stub.close()
+    pool = ProxyPool([proxy])
+    latency = await pool.probe(proxy, timeout=2)
+    results.append(('порт не отвечает: прокси в карантине', latency is None and pool.stats[proxy].failures == 1,
+                    f'результат {latency}, ошибок {pool.stats[proxy].failures}'))
+
+
+async def check_quarantine_growth(results):
+    stub = await Socks5Stub('reject').start()
+    try:
+        proxy = stub.proxy()
+        pool = ProxyPool([proxy])
+        timeouts = []
+        for _ in range(3):
+            await pool.probe(proxy, timeout=2)
+            timeouts.append(quarantine_left(pool, proxy))
+        expected = [QUARANTINE_BASE, QUARANTINE_BASE * 2, QUARANTINE_BASE * 4]
+        results.append(('карантин растёт с каждой ошибкой подряд', timeouts == expected,
+                        f'карантин {timeouts} с, ожидалось {expected}'))
+        stub.mode = 'ok'
+        latency = await pool.probe(proxy, timeout=2)
+        s = pool.stats[proxy]
+        results.append(('успех сбрасывает счётчик ошибок', latency is not None and s.consecutive_failures == 0,
+                        f'результат {latency}, ошибок подряд {s.consecutive_failures}'))
+        try:
+            issued = pool.get_proxy()
+        except Exception as e:
+            issued = e
+        results.append(('успех снимает карантин', issued == proxy and not s.quarantined_until,
+                        f'выдан {issued!r}, карантин до {s.quarantined_until}'))
+    finally:
+        await stub.close()
+
+
+async def check_health_checks(results):
+    good = await Socks5Stub('ok').start()
+    bad = await Socks5Stub('reject').start()
+    try:
+        pool = ProxyPool([good.proxy(), bad.proxy()])
+        task = pool.start_health_checks(interval=0.05, timeout=2)
+        same_task = pool.start_health_checks(interval=0.05, timeout=2) is task
+        await asyncio.sleep(0.3)
+        pool.stop_health_checks()
+        await asyncio.sleep(0)
+        good_stats, bad_stats = pool.stats[good.proxy()], pool.stats[bad.proxy()]
+        results.append(('фоновые проверки идут по расписанию',
+                        same_task and good_stats.successes >= 2 and bad_stats.failures >= 2 and task.cancelled(),
+                        f'успехов {good_stats.successes}, ошибок {bad_stats.failures}, задача отменена: {task.cancelled()}'))
+        results.append(('пул выдаёт только здоровый прокси', pool.get_proxy() == good.proxy(),
+                        f'выдан {pool.get_proxy()}'))
+    finally:
+        await good.close()
+        await bad.close()
+
+
+async def run_checks():
+    """Все проверки; возвращает список (название, прошла ли, подробности)"""
+    results = []
+    for check in (check_greeting, check_failures, check_quarantine_growth, check_health_checks):
+        await check(results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка ProxyPool на локальной заглушке SOCKS5')
+    parser.add_argument('--verbose', action='store_true', help='показывать предупреждения пула')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.ERROR)
+    results = asyncio.run(run_checks())
+    for name, ok, details in results:
+        print(f"{'OK ' if ok else 'FAIL'} {name}: {details}")
+    failed = sum(not ok for _, ok, _ in results)
+    print(f"Проверок: {len(results)}, не прошло: {failed}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,149 @@
+import asyncio
+import bisect
+import logging
 import random
 import time
 from proxies import PROXIES
 
+logger = logging.getLogger(__name__)
+
+DEFAULT_LATENCY = 1.0  # секунд, пока прокси ещё не измерен
+LATENCY_ALPHA = 0.3  # вес нового замера в скользящем среднем
+QUARANTINE_BASE = 30  # секунд карантина после первой ошибки
+QUARANTINE_MAX = 3600
+
+
+class ProxyStats:
+    """Статистика одного прокси: задержка подключения и ошибки"""
+
+    def __init__(self):
+        self.latency = None
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.quarantined_until = 0.0
+
+    @property
+    def success_rate(self):
+        # Сглаживание Лапласа: новый прокси получает 0.5, а не 0 или 1
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+
 class ProxyPool:
+    """
+    Пул прокси с выбором по весу: быстрые и стабильные прокси выдаются чаще
+    (вес = доля успешных подключений / задержка). Прокси с ошибками уходят
+    в карантин с экспоненциально растущим сроком; пул умеет проверять
+    прокси в фоне, подключаясь к ним и выполняя приветствие SOCKS5.
+    """
+
     def __init__(self, proxies):
         self.all_proxies = proxies.copy()
-        self.blocked = {}
+        self.stats = {proxy: ProxyStats() for proxy in self.all_proxies}
+        self.health_task = None
+        self._candidates = None
+        self._cumulative = None
+        self._valid_until = 0.0
+
+    @property
+    def blocked(self):
+        return {proxy: s.quarantined_until for proxy, s in self.stats.items() if s.quarantined_until}
+
+    def _rebuild(self, now):
+        """Пересчитывает кандидатов и накопленные веса; до ближайшего выхода из карантина кэш действителен"""
+        known = [s.latency for s in self.stats.values() if s.latency is not None]
+        default_latency = sorted(known)[len(known) // 2] if known else DEFAULT_LATENCY
+        self._candidates, self._cumulative = [], []
+        total = 0.0
+        next_release = float('inf')
+        for proxy, s in self.stats.items():
+            if s.quarantined_until > now:
+                next_release = min(next_release, s.quarantined_until)
+                continue
+            total += s.success_rate / max(s.latency or default_latency, 0.001)
+            self._candidates.append(proxy)
+            self._cumulative.append(total)
+        self._valid_until = next_release
+
+    def _invalidate(self):
+        self._candidates = None
 
     def get_proxy(self):
         now = time.time()
-        available = [p for p in self.all_proxies if self.blocked.get(p, 0) < now]
-        if not available:
+        if self._candidates is None or now >= self._valid_until:
+            self._rebuild(now)
+        if not self._candidates:
             raise Exception("Нет доступных прокси!")
-        return random.choice(available)
+        point = random.random() * self._cumulative[-1]
+        return self._candidates[bisect.bisect_right(self._cumulative, point)]
 
     def block_proxy(self, proxy, timeout=3600):
-        self.blocked[proxy] = time.time() + timeout 
\ No newline at end of file
+        self.stats.setdefault(proxy, ProxyStats()).quarantined_until = time.time() + timeout
+        self._invalidate()
+
+    def report_success(self, proxy, latency=None):
+        """Успешное подключение или проверка: прокси снова в строю, карантин снимается"""
+        s = self.stats.setdefault(proxy, ProxyStats())
+        s.successes += 1
+        s.consecutive_failures = 0
+        s.quarantined_until = 0.0
+        if latency is not None:
+            s.latency = latency if s.latency is None else (1 - LATENCY_ALPHA) * s.latency + LATENCY_ALPHA * latency
+        self._invalidate()
+
+    def report_failure(self, proxy):
+        """Ошибка подключения: карантин 30 с, 60 с, 120 с... но не больше часа"""
+        s = self.stats.setdefault(proxy, ProxyStats())
+        s.failures += 1
+        s.consecutive_failures += 1
+        timeout = min(QUARANTINE_BASE * 2 ** (s.consecutive_failures - 1), QUARANTINE_MAX)
+        s.quarantined_until = time.time() + timeout
+        logger.warning(f"Прокси {proxy[1]}:{proxy[2]} в карантине на {timeout} секунд (ошибок подряд: {s.consecutive_failures})")
+        self._invalidate()
+
+    async def probe(self, proxy, timeout=10):
+        """
+        Проверка прокси: TCP-подключение и, для SOCKS5, приветствие протокола.
+        Результат учитывается в статистике; возвращает задержку или None.
+        """
+        proxy_type, host, port = proxy[0], proxy[1], proxy[2]
+        has_auth = len(proxy) > 4 and proxy[4]
+        started = time.perf_counter()
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            if str(proxy_type).lower() == 'socks5':
+                # Версия 5, поддерживаемые методы: без аутентификации и/или логин-пароль
+                writer.write(b'\x05\x02\x00\x02' if has_auth else b'\x05\x01\x00')
+                await writer.drain()
+                reply = await asyncio.wait_for(reader.readexactly(2), timeout)
+                if reply[0] != 5 or reply[1] == 0xFF:
+                    raise ConnectionError(f"некорректный ответ SOCKS5: {reply!r}")
+            latency = time.perf_counter() - started
+        except Exception as e:
+            logger.debug(f"Проверка прокси {host}:{port} не прошла: {e}")
+            self.report_failure(proxy)
+            return None
+        finally:
+            if writer is not None:
+                writer.close()
+        self.report_success(proxy, latency)
+        return latency
+
+    async def probe_all(self, timeout=10):
+        return await asyncio.gather(*(self.probe(proxy, timeout) for proxy in list(self.stats)))
+
+    def start_health_checks(self, interval=300, timeout=10):
+        """Запускает фоновую периодическую проверку всех прокси"""
+        async def loop():
+            while True:
+                await self.probe_all(timeout)
+                await asyncio.sleep(interval)
+        if self.health_task is None or self.health_task.done():
+            self.health_task = asyncio.ensure_future(loop())
+        return self.health_task
+
+    def stop_health_checks(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            self.health_task = None
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Лимиты по умолчанию: (токенов в секунду, размер "пачки")
+DEFAULT_LIMITS = {
+    'ResolveUsername': (1 / 10, 3),
+    'GetFullChannelRequest': (1 / 5, 3),
+    'GetChannelsRequest': (1 / 2, 3),
+    'GetHistoryRequest': (1.0, 5),
+}
+DEFAULT_LIMIT = (1.0, 5)
+
+
+class TokenBucket:
+    """
+    Token bucket: `capacity` запросов можно сделать сразу, дальше — `rate` запросов в секунду.
+    Токены резервируются заранее (баланс может уйти в минус), поэтому ожидающие
+    корутины обслуживаются в порядке очереди без отдельной блокировки.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Резервирует токен и возвращает, сколько секунд нужно подождать до его появления"""
+        self._refill()
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    async def acquire(self):
+        """Ждёт токен; возвращает, сколько секунд пришлось ждать"""
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """Набор token bucket'ов по ключу (аккаунт, метод API)"""
+
+    def __init__(self, limits=None, default=DEFAULT_LIMIT):
+        self.limits = dict(DEFAULT_LIMITS)
+        if limits:
+            self.limits.update(limits)
+        self.default = default
+        self.buckets = {}
+
+    def bucket(self, account, method):
+        key = (account, method)
+        if key not in self.buckets:
+            rate, capacity = self.limits.get(method, self.default)
+            self.buckets[key] = TokenBucket(rate, capacity)
+        return self.buckets[key]
+
+    async def acquire(self, account, method):
+        """Ждёт, только если бюджет аккаунта на данный метод исчерпан"""
+        wait = await self.bucket(account, method).acquire()
+        if wait > 0:
+            logger.debug(f"Rate limit: аккаунт {account}, {method} — ждал {wait:.1f} с")
+        return wait
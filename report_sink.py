@@ -0,0 +1,254 @@
+"""
+Потоковая запись отчётов: строки дописываются по мере готовности, в памяти
+хранится не больше одной пачки. Итоговый формат — по расширению файла:
+.csv, .xlsx (openpyxl в режиме write-only) или .parquet (нужен pyarrow).
+
+Снимок промежуточного отчёта в любой момент, в том числе из другого процесса:
+
+    python report_sink.py report_20250101_120000.xlsx.spool.jsonl snapshot.xlsx
+"""
+import csv
+import json
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'xlsx', 'parquet')
+# Сколько строк за раз передаётся в pyarrow при записи Parquet
+PARQUET_BATCH = 1000
+
+
+def report_format(path):
+    fmt = os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат отчёта: {path} (поддерживаются {', '.join(FORMATS)})")
+    return fmt
+
+
+def _cell(value):
+    """Значение для ячейки xlsx/csv: вложенные структуры — строкой JSON"""
+    if isinstance(value, (dict, list, tuple, set)):
+        return json.dumps(list(value) if isinstance(value, set) else value, ensure_ascii=False, default=str)
+    return value
+
+
+class ReportSink:
+    """
+    Отчёт, который пишется построчно. CSV дописывается прямо в итоговый файл;
+    для xlsx и Parquet строки копятся в JSONL-спуле (типы значений сохраняются),
+    а итоговый файл собирается из спула потоково — snapshot() в любой момент
+    и close() в конце. Повторное открытие того же пути продолжает отчёт.
+    """
+
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.format = report_format(path)
+        self.columns = list(columns) if columns else None
+        self.rows = 0
+        self.spool_path = path if self.format == 'csv' else f'{path}.spool.jsonl'
+        if self.format == 'csv':
+            exists = os.path.exists(path) and os.path.getsize(path) > 0
+            if exists and self.columns is None:
+                with open(path, 'r', encoding='utf-8', newline='') as f:
+                    self.columns = next(csv.reader(f), None)
+            self.file = open(path, 'a', encoding='utf-8', newline='')
+            self.writer = None
+            self._header_written = exists
+        else:
+            self.file = open(self.spool_path, 'a', encoding='utf-8')
+
+    def write(self, row):
+        """Дописывает строку (dict) и сразу сбрасывает её на диск"""
+        if self.columns is None:
+            self.columns = list(row)
+        if self.format == 'csv':
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file, fieldnames=self.columns, extrasaction='ignore')
+                if not self._header_written:
+                    self.writer.writeheader()
+                    self._header_written = True
+            self.writer.writerow({column: _cell(row.get(column)) for column in self.columns})
+        else:
+            self.file.write(json.dumps(row, ensure_ascii=False, default=str) + '\n')
+        self.file.flush()
+        self.rows += 1
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+        return self
+
+    def snapshot(self, path=None):
+        """Собирает отчёт из уже записанных строк; по умолчанию — в итоговый файл"""
+        path = path or self.path
+        self.file.flush()
+        if self.format == 'csv' and path == self.path:
+            return path
+        return export_spool(self.spool_path, path, self.columns, spool_format='csv' if self.format == 'csv' else 'jsonl')
+
+    def close(self):
+        """Закрывает спул и собирает итоговый файл; возвращает его путь"""
+        if self.file.closed:
+            return self.path
+        self.file.close()
+        if self.format == 'csv':
+            return self.path
+        if os.path.getsize(self.spool_path) == 0:
+            # Ни одной строки — пустой отчёт не создаём
+            os.remove(self.spool_path)
+            return None
+        export_spool(self.spool_path, self.path, self.columns)
+        os.remove(self.spool_path)
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_spool(spool_path, spool_format='jsonl'):
+    """Строки спула по одной (JSONL или CSV, если отчёт и так в CSV)"""
+    with open(spool_path, 'r', encoding='utf-8', newline='') as f:
+        if spool_format == 'csv':
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # Последняя строка могла оборваться при падении
+                continue
+
+
+def export_spool(spool_path, path, columns=None, spool_format=None):
+    """
+    Потоково переписывает спул в файл path (формат по расширению).
+    Файл заменяется атомарно, так что читатель видит либо старый снимок, либо новый.
+    """
+    if spool_format is None:
+        spool_format = 'csv' if spool_path.endswith('.csv') else 'jsonl'
+    fmt = report_format(path)
+    rows = iter_spool(spool_path, spool_format)
+    if columns is None:
+        first = next(rows, None)
+        columns = list(first) if first else []
+        rows = _prepend(first, rows)
+    tmp_path = f'{path}.tmp.{fmt}'
+    try:
+        if fmt == 'csv':
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+                writer.writeheader()
+                for row in rows:
+                    writer.writerow({column: _cell(row.get(column)) for column in columns})
+        elif fmt == 'xlsx':
+            _write_xlsx(tmp_path, columns, rows)
+        else:
+            # Типы колонок Parquet выводятся по всему спулу, поэтому он читается дважды
+            _write_parquet(tmp_path, columns, rows, lambda: iter_spool(spool_path, spool_format))
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    logger.info(f"Отчёт сохранён в файл: {path}")
+    return path
+
+
+def _prepend(first, rows):
+    if first is not None:
+        yield first
+    yield from rows
+
+
+def _write_xlsx(path, columns, rows):
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(columns)
+    for row in rows:
+        sheet.append([_cell(row.get(column)) for column in columns])
+    workbook.save(path)
+
+
+# Тип колонки Parquet по типам её значений; смесь int и float — float, любая другая смесь — строка
+_PARQUET_KINDS = {bool: 'bool', int: 'int', float: 'float'}
+
+
+def _value_kind(value):
+    return _PARQUET_KINDS.get(type(value), 'string')
+
+
+def column_kinds(columns, rows):
+    """
+    Тип каждой колонки ('bool', 'int', 'float' или 'string') по всем строкам.
+    Колонка, в которой нет ни одного значения, считается строковой, так что
+    типы не зависят от того, какие строки попали в первую пачку.
+    """
+    kinds = dict.fromkeys(columns)
+    for row in rows:
+        for column in columns:
+            value = _cell(row.get(column))
+            if value is None:
+                continue
+            kind, current = _value_kind(value), kinds[column]
+            if current is None or current == kind:
+                kinds[column] = kind
+            elif {current, kind} == {'int', 'float'}:
+                kinds[column] = 'float'
+            else:
+                kinds[column] = 'string'
+    return {column: kind or 'string' for column, kind in kinds.items()}
+
+
+def _coerce(value, kind):
+    if value is None:
+        return None
+    if kind == 'string':
+        return value if isinstance(value, str) else str(value)
+    if kind == 'float':
+        return float(value)
+    return value
+
+
+def _write_parquet(path, columns, rows, reread=None):
+    """
+    rows — строки отчёта; reread() — заново те же строки (для вывода типов колонок).
+    Без reread строки один раз читаются в память.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Для отчётов в Parquet нужен pyarrow: pip install pyarrow")
+
+    if reread is None:
+        rows = list(rows)
+        reread = lambda: rows
+    kinds = column_kinds(columns, reread())
+    types = {'bool': pa.bool_(), 'int': pa.int64(), 'float': pa.float64(), 'string': pa.string()}
+    schema = pa.schema([pa.field(column, types[kinds[column]], nullable=True) for column in columns])
+    writer = pq.ParquetWriter(path, schema)
+    try:
+        batch = []
+        for row in rows:
+            batch.append({column: _coerce(_cell(row.get(column)), kinds[column]) for column in columns})
+            if len(batch) >= PARQUET_BATCH:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    finally:
+        writer.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Использование: python report_sink.py <спул или отчёт .csv> <снимок.csv|.xlsx|.parquet>')
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    export_spool(sys.argv[1], sys.argv[2])
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# Этапы обработки чата по порядку; 'failed' — чат завершён со статусом Error
+STAGES = ('resolved', 'fetched', 'written', 'scored')
+FINAL_STAGES = ('scored', 'failed')
+
+
+class RunJournal:
+    """
+    Журнал прогона (append-only JSONL): для каждого чата фиксируется пройденный этап
+    — resolved (информация о чате), fetched (активность), written (запись в Notion),
+    scored (ML-оценка) — вместе с его результатом. Каждая запись сразу сбрасывается
+    на диск, поэтому после падения перезапуск продолжает с первого незавершённого
+    этапа, а не анализирует чаты заново.
+    """
+
+    def __init__(self, path='run_journal.jsonl', max_age=timedelta(hours=24)):
+        self.path = path
+        self.max_age = max_age
+        self.chats = {}
+        self._load()
+        self._compact()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Последняя строка могла оборваться при падении
+                    continue
+                entry = self.chats.setdefault(record['chat_id'], {'stages': {}})
+                entry['page_id'] = record.get('page_id') or entry.get('page_id')
+                entry['stage'] = record['stage']
+                entry['stages'][record['stage']] = {'ts': record['ts'], 'data': record.get('data')}
+
+    def _compact(self):
+        """Оставляет в журнале только свежие незавершённые чаты"""
+        cutoff = datetime.now(timezone.utc) - self.max_age
+        self.chats = {
+            chat_id: entry for chat_id, entry in self.chats.items()
+            if entry['stage'] not in FINAL_STAGES
+            and datetime.fromisoformat(entry['stages'][entry['stage']]['ts']) > cutoff
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for chat_id, entry in self.chats.items():
+                for stage in STAGES:
+                    if stage in entry['stages']:
+                        f.write(self._line(chat_id, stage, entry['page_id'], **entry['stages'][stage]))
+        os.replace(tmp_path, self.path)
+        if self.chats:
+            logger.info(f"Журнал прогона: {len(self.chats)} незавершённых чатов из прошлого запуска")
+
+    @staticmethod
+    def _line(chat_id, stage, page_id, ts, data=None):
+        return json.dumps(
+            {'chat_id': chat_id, 'page_id': page_id, 'stage': stage, 'ts': ts, 'data': data},
+            ensure_ascii=False, default=str
+        ) + '\n'
+
+    def record(self, chat_id, stage, data=None, page_id=None):
+        """Фиксирует завершение этапа; запись на диске до возврата из метода"""
+        ts = datetime.now(timezone.utc).isoformat()
+        entry = self.chats.setdefault(chat_id, {'stages': {}, 'page_id': page_id})
+        entry['page_id'] = page_id or entry.get('page_id')
+        entry['stage'] = stage
+        entry['stages'][stage] = {'ts': ts, 'data': data}
+        self.file.write(self._line(chat_id, stage, entry['page_id'], ts, data))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def is_done(self, chat_id, stage):
+        entry = self.chats.get(chat_id)
+        return bool(entry) and stage in entry['stages']
+
+    def data(self, chat_id, stage):
+        """Результат пройденного этапа или None"""
+        entry = self.chats.get(chat_id)
+        if not entry or stage not in entry['stages']:
+            return None
+        return entry['stages'][stage]['data']
+
+    def pending(self, stage):
+        """Чаты, остановившиеся ровно на этапе stage: [(chat_id, page_id, data)]"""
+        return [
+            (chat_id, entry.get('page_id'), entry['stages'][stage]['data'])
+            for chat_id, entry in self.chats.items() if entry['stage'] == stage
+        ]
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,123 @@
+"""
+Проверка выборочной оценки DAU на синтетическом Telegram из fake_telegram.py:
+для чатов, чья история за 30 дней не влезает в лимит чтения, сравниваются
+истинный средний DAU (по всем сообщениям чата, за полные сутки окна),
+средний DAU усечённого лимитом прохода и выборочная оценка (sample_daily_activity).
+
+    python sampling_check.py --chats 60
+
+Код возврата 0, если выборка в среднем ближе к истине, чем усечённый проход,
+и её 95% доверительный интервал накрывает истину не реже, чем в 80% чатов.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import bot
+from benchmark import OfflineNotion, scaled_rate_limiter
+from fake_telegram import FakeTelegram
+
+# Доля чатов, в которых 95% ДИ должен накрыть истину (с запасом на небольшую выборку чатов)
+MIN_COVERAGE = 0.8
+
+
+def true_avg_dau(chat, now_ts, days):
+    """Среднее число уникальных отправителей за полные сутки (UTC) окна, включая дни без сообщений"""
+    first_day = int(now_ts - days * 86400) // 86400 + 1
+    last_day = int(now_ts) // 86400  # текущие сутки ещё не закончились
+    senders_by_day = defaultdict(set)
+    for ts, sender in zip(chat.dates, chat.senders):
+        day = ts // 86400
+        if sender and first_day <= day < last_day:
+            senders_by_day[day].add(sender)
+    return sum(len(senders) for senders in senders_by_day.values()) / (last_day - first_day)
+
+
+async def compare(args):
+    """Строки (чат, сообщений за окно, истина, усечённый проход, выборка, ДИ, запросов на выборку)"""
+    backend = FakeTelegram(chats=args.chats, seed=args.seed, speedup=args.speedup)
+    accounts = [{'api_id': '0', 'api_hash': '', 'session': 'check_0'}]
+    rows = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(workdir)
+        analyzer = None
+        try:
+            analyzer = bot.TelegramAnalyzer(accounts=accounts, client_factory=backend.client_factory, notion=OfflineNotion())
+            analyzer.rate_limiter = scaled_rate_limiter(args.speedup)
+            await analyzer.start()
+            now_ts = time.time()
+            for chat in backend.chats:
+                in_window = sum(1 for ts in chat.dates if ts > now_ts - args.days * 86400)
+                if in_window <= args.limit + 100 or not chat.megagroup:
+                    continue
+                saved = bot.DAU_SAMPLES
+                bot.DAU_SAMPLES = 0
+                try:
+                    truncated = await analyzer.analyze_activity(chat.username, days=args.days, limit=args.limit, incremental=False)
+                finally:
+                    bot.DAU_SAMPLES = saved
+                before = sum(backend.requests.values())
+                sampled = await analyzer.analyze_activity(chat.username, days=args.days, limit=args.limit, incremental=False)
+                requests = sum(backend.requests.values()) - before
+                if sampled.get('avg_dau_method') != 'sampling':
+                    continue
+                rows.append((chat.username, in_window, true_avg_dau(chat, now_ts, args.days), truncated['avg_dau'],
+                             sampled['avg_dau'], sampled['avg_dau_ci'], requests))
+        finally:
+            if analyzer:
+                await asyncio.to_thread(analyzer.writer.close)
+                analyzer.journal.close()
+                analyzer.tracer.close()
+                analyzer.cache.close()
+                analyzer.watermarks.close()
+                analyzer.entity_cache.close()
+            os.chdir(cwd)
+    return rows
+
+
+def relative_error(value, truth):
+    return abs(value - truth) / truth if truth else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение выборочной оценки DAU с усечённым проходом')
+    parser.add_argument('--chats', type=int, default=60, help='чатов в синтетическом Telegram (проверяются только большие)')
+    parser.add_argument('--limit', type=int, default=3000, help='лимит чтения истории')
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--speedup', type=float, default=1000.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+
+    rows = asyncio.run(compare(args))
+    if not rows:
+        print('Нет чатов, история которых не влезает в лимит — увеличьте --chats')
+        sys.exit(1)
+    print(f"{'чат':<16}{'сообщ.':>9}{'истина':>9}{'усечён.':>9}{'выборка':>9}{'95% ДИ':>20}{'запр.':>7}")
+    covered = 0
+    truncated_error = sampled_error = 0.0
+    for name, messages, truth, truncated, sampled, ci, requests in rows:
+        hit = ci is not None and ci[0] <= truth <= ci[1]
+        covered += hit
+        truncated_error += relative_error(truncated, truth)
+        sampled_error += relative_error(sampled, truth)
+        ci_text = f"{ci[0]:.1f}–{ci[1]:.1f}{'' if hit else ' ✗'}" if ci else '—'
+        print(f"{name:<16}{messages:>9}{truth:>9.1f}{truncated:>9.1f}{sampled:>9.1f}{ci_text:>20}{requests:>7}")
+    truncated_error /= len(rows)
+    sampled_error /= len(rows)
+    coverage = covered / len(rows)
+    print(f"Средняя относительная ошибка: усечённый проход {truncated_error:.1%}, выборка {sampled_error:.1%}; "
+          f"ДИ накрывает истину в {coverage:.0%} чатов")
+    sys.exit(0 if sampled_error < truncated_error and coverage >= MIN_COVERAGE else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Трассировка обработки чатов: каждый чат — trace со своим id, каждый этап — span
+с путём вложенности (chat/analyze_activity/GetHistoryRequest) и длительностью.
+Спаны пишутся компактным JSONL, по одной строке на span.
+
+Файл пишется заново на каждый запуск, предыдущий запуск сохраняется в traces.jsonl.1.
+Сводка по последнему запуску:
+
+    python tracing.py traces.jsonl
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# Текущий span задачи: (trace_id, chat_id, путь); у каждой asyncio-задачи свой
+_current = ContextVar('trace_span', default=None)
+
+# Спаны, в которых время уходит на ожидание, а не на работу
+WAIT_SPANS = ('wait_account', 'flood_wait', 'rate_limit', 'cooldown')
+# Ожидания короче этого (секунды) не записываются — это не ожидание, а накладные расходы
+MIN_RECORDED = 0.001
+
+
+class Tracer:
+    def __init__(self, path='traces.jsonl', enabled=True):
+        self.path = path
+        self.enabled = enabled and bool(path)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.file = None
+        if self.enabled:
+            if os.path.exists(path):
+                # Файл не растёт от запуска к запуску: хранится только один предыдущий
+                os.replace(path, f'{path}.1')
+            self.file = open(path, 'w', encoding='utf-8')
+
+    def _write(self, trace_id, chat_id, path, start, duration, attrs):
+        record = {'run': self.run_id, 'trace': trace_id, 'chat': chat_id, 'path': path,
+                  'start': round(start, 3), 'dur': round(duration, 4)}
+        if attrs:
+            record.update(attrs)
+        self.file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    @contextmanager
+    def trace(self, chat_id, **attrs):
+        """Корневой span обработки чата; в attrs можно дописать итог (например, status)"""
+        if not self.enabled:
+            yield attrs
+            return
+        trace_id = uuid.uuid4().hex[:16]
+        token = _current.set((trace_id, chat_id, 'chat'))
+        started_at, started = time.time(), time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            _current.reset(token)
+            self._write(trace_id, chat_id, 'chat', started_at, time.perf_counter() - started, attrs)
+            self.file.flush()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Этап внутри текущего trace (вне trace пишется без chat и trace id)"""
+        if not self.enabled:
+            yield attrs
+            return
+        parent = _current.get()
+        trace_id, chat_id, parent_path = parent or (None, None, None)
+        path = f'{parent_path}/{name}' if parent_path else name
+        token = _current.set((trace_id, chat_id, path))
+        started_at, started = time.time(), time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            _current.reset(token)
+            self._write(trace_id, chat_id, path, started_at, time.perf_counter() - started, attrs)
+
+    def record(self, name, duration, **attrs):
+        """Span, закончившийся только что и длившийся duration секунд (например, ожидание)"""
+        if not self.enabled or duration < MIN_RECORDED:
+            return
+        trace_id, chat_id, parent_path = _current.get() or (None, None, None)
+        path = f'{parent_path}/{name}' if parent_path else name
+        self._write(trace_id, chat_id, path, time.time() - duration, duration, attrs)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def load_spans(path, run_id=None):
+    """Спаны из файла: только запуск run_id, по умолчанию — последний"""
+    spans = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    if run_id == 'all' or not spans:
+        return spans
+    run_id = run_id or spans[-1]['run']
+    return [span for span in spans if span['run'] == run_id]
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def summarize(spans):
+    """Текстовая сводка: куда уходит время по этапам и сколько — на ожидание"""
+    if not spans:
+        return 'Нет спанов'
+    by_path = defaultdict(list)
+    for span in spans:
+        by_path[span['path']].append(span['dur'])
+    chats = [span for span in spans if span['path'] == 'chat']
+    chat_time = sum(span['dur'] for span in chats)
+    wall = max(s['start'] + s['dur'] for s in spans) - min(s['start'] for s in spans)
+    statuses = defaultdict(int)
+    for span in chats:
+        statuses[span.get('status', '?')] += 1
+
+    runs = sorted({span['run'] for span in spans})
+    lines = [
+        f"Запуск {', '.join(runs)}: {len(chats)} чатов "
+        f"({', '.join(f'{k}: {v}' for k, v in sorted(statuses.items()))}), "
+        f"реальное время {wall:.0f} с, суммарно в чатах {chat_time:.0f} с",
+        f"{'этап':<58}{'кол-во':>8}{'всего, с':>10}{'доля':>7}{'p50, с':>9}{'p95, с':>9}",
+    ]
+    # chat и его потомки — в порядке дерева, спаны вне чатов (ожидание аккаунта, паузы) — после
+    for path in sorted(by_path, key=lambda p: (not p.startswith('chat'), p)):
+        durations = by_path[path]
+        total = sum(durations)
+        depth = path.count('/')
+        name = '  ' * depth + path.rsplit('/', 1)[-1]
+        share = f"{total / chat_time:.0%}" if chat_time and path.startswith('chat') else '—'
+        lines.append(
+            f"{name:<58}{len(durations):>8}{total:>10.1f}{share:>7}"
+            f"{_percentile(durations, 0.5):>9.2f}{_percentile(durations, 0.95):>9.2f}"
+        )
+    waits = defaultdict(float)
+    for span in spans:
+        name = span['path'].rsplit('/', 1)[-1]
+        if name in WAIT_SPANS:
+            waits[name] += span['dur']
+    if waits:
+        lines.append('Ожидание: ' + ', '.join(f'{name} {seconds:.1f} с' for name, seconds in sorted(waits.items())))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сводка по трассировке анализа чатов')
+    parser.add_argument('path', nargs='?', default='traces.jsonl')
+    parser.add_argument('--run', default=None, help="id запуска (по умолчанию последний, 'all' — все)")
+    args = parser.parse_args()
+    print(summarize(load_spans(args.path, args.run)))
+
+
+if __name__ == '__main__':
+    main()
@@ -20,20 +20,12 @@ def update_chat_metrics(chat_id: str, metrics: dict):
     notion = NotionIntegration()
     
     # Получаем страницу чата
-    response = notion.notion.databases.query(
-        database_id=notion.database_id,
-        filter={
-            "property": "Канал/чат",
-            "rich_text": {
-                "equals": chat_id
-            }
-        }
-    )
-    if not response.get('results'):
+    page = notion.find_chat_page(chat_id)
+    if page is None:
         logger.error(f"Чат {chat_id} не найден в базе данных")
         return False
     
-    page_id = response['results'][0]['id']
+    page_id = page['id']
     
     # Обновляем метрики
     properties = {
@@ -46,10 +38,7 @@ def update_chat_metrics(chat_id: str, metrics: dict):
     }
     
     try:
-        notion.notion.pages.update(
-            page_id=page_id,
-            properties=properties
-        )
+        notion.update_page(page_id, properties)
         logger.info(f"Метрики для чата {chat_id} успешно обновлены")
         
         # Запускаем оценку качества